@@ -0,0 +1,329 @@
+"""
+Benchmarks every stage of loading and using a language, on made up languages of any size or on a real one, and writes
+the timings as JSON so runs on different versions can be compared.
+
+    python bench.py                                   # made up languages, 1k and 10k morphemes with 10 and 100 rules
+    python bench.py --morphemes 1000 100000 1000000 --rules 10 1000 --syllable "CV" "(C)(C)V(C)"
+    python bench.py --lang lang1 --repeat 5 --out lang1.json
+    python bench.py --out new.json --compare old.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import kiershenbaum
+from dictionary import Dictionary
+from language import Language
+from phoneme import IPA
+
+# Roman letter to IPA, every sound that generated rules can turn these into is in here too
+CONSONANTS = {"p": "p", "b": "b", "t": "t", "d": "d", "k": "k", "g": "g", "m": "m", "n": "n", "f": "f", "v": "v",
+              "s": "s", "z": "z", "l": "l", "r": "r", "j": "j", "w": "w"}
+VOWELS = {"a": "a", "e": "e", "i": "i", "o": "o", "u": "u"}
+
+# Stress expressions, see SyllableData.compile_stress
+STRESS = [
+    ("l == 1 or i == l - 2", "i < l - 4 and i % 3 == 1"),
+    ("i == 0", "i > 1 and i % 2 == 0"),
+    ("i == l - 1", "i < 0"),  # Attributes are lowercased, so no True or False
+]
+
+MAX_ERROR_RATE = 0.5  # Stages failing more often than this mostly time error handling, so the run stops instead
+
+# Pattern terms, and what rule actions are safe to apply to a phoneme matched by them
+ANY_TERMS = ["VOW", "CONS", "PLO", "NAS", "FRI", "FRONT", "BACK", "CLOSE", "STRESSED", "UNSTRESSED", "!VOW", "!NAS",
+             "VOW START", "CONS END"] + ["*" + ipa for ipa in list(CONSONANTS.values()) + list(VOWELS.values())]
+CONSONANT_TERMS = ["CONS", "PLO", "NAS", "FRI", "!VOW"] + ["*" + ipa for ipa in CONSONANTS.values()]
+ACTIONS = [
+    (["PLO", "FRI"], 'p[{}]["voicing"] = "voiced"'),
+    (["PLO", "FRI"], 'p[{}]["voicing"] = "unvoiced"'),
+    (["PLO", "NAS"], 'p[{}]["place"] = "bilabial"'),
+    (["PLO", "NAS"], 'p[{}]["place"] = "alveolar"'),
+    (["PLO"], 'p[{}]["place"] = "velar"'),
+    (["CLOSE"], 'p[{}]["height"] = "close_mid"'),
+    (["CLOSE_MID"], 'p[{}]["height"] = "close"'),
+    (["VOW", "VOW UNSTRESSED"], 'p[{}]["length"] = "long"'),
+]
+
+
+def generate(path, morphemes=1000, rules=10, syllable="(C)V(C)", words=None, seed=0):
+    """
+    Writes a made up language to the directory at path, in the same files as lang1. It has morphemes morphemes (about
+    1 in 20 bound), words compounds of them (morphemes // 2 by default) and rules random rules, and its syllables
+    follow syllable
+    """
+    rng = random.Random(seed)
+    words = morphemes // 2 if words is None else words
+    os.makedirs(path, exist_ok=True)
+
+    with open(os.path.join(path, Language.FILES["romanization"]), "w", encoding="utf-8") as f:
+        for roman, ipa in list(CONSONANTS.items()) + list(VOWELS.items()):
+            f.write("{}   {}\n".format(roman, ipa))
+
+    primary, secondary = rng.choice(STRESS)
+    with open(os.path.join(path, Language.FILES["attributes"]), "w", encoding="utf-8") as f:
+        f.write("SYLLABLE: {}\nPRIMARY_STRESS: {}\nSECONDARY_STRESS: {}\n".format(syllable, primary, secondary))
+
+    with open(os.path.join(path, Language.FILES["rules"]), "w", encoding="utf-8") as f:
+        for _ in range(rules):
+            f.write(_random_rule(rng) + "\n")
+
+    onset, coda = syllable.upper().split("V")
+    consonants = list(CONSONANTS)
+    vowels = list(VOWELS)
+
+    def cluster(template):
+        required = template.count("C") - template.count("(")
+        return "".join(rng.choice(consonants) for _ in range(rng.randint(required, template.count("C"))))
+
+    with open(os.path.join(path, Language.FILES["dictionary"]), "w", encoding="utf-8") as f:
+        free = []
+        bound = []
+
+        for i in range(morphemes):
+            text = "".join(cluster(onset) + rng.choice(vowels) + cluster(coda) for _ in range(rng.randint(1, 3)))
+            tag = "M{}".format(i)
+
+            if rng.random() < 0.05:
+                text += "-"
+                bound.append(tag)
+            else:
+                free.append(tag)
+
+            f.write("{}\t{}\tthing {}\n".format(text, tag, i))
+
+        for i in range(words):
+            tags = [rng.choice(free) for _ in range(rng.randint(2, 3))]
+            if bound and rng.random() < 0.2:
+                tags.insert(0, rng.choice(bound))
+
+            f.write("{}\t\tcompound {}\n".format("+".join(tags), i))
+
+
+def _random_rule(rng):
+    mode = "all: " if rng.random() < 0.2 else ""
+
+    if rng.random() < 0.3:
+        # Only consonants next to another consonant are removed, so words still fit the syllable template
+        terms = [rng.choice(CONSONANT_TERMS), rng.choice(CONSONANT_TERMS)]
+        return "{}({})({})  p[{}].rem()".format(mode, terms[0], terms[1], rng.randrange(2))
+
+    length = rng.randint(1, 3)
+    terms = [rng.choice(ANY_TERMS) for _ in range(length)]
+
+    actions = []
+    for index in rng.sample(range(length), min(length, rng.randint(1, 2))):  # One action per phoneme at most
+        allowed, action = rng.choice(ACTIONS)
+        terms[index] = rng.choice(allowed)  # The action has to make sense for the phoneme it changes
+        actions.append(action.format(index))
+
+    return "{}{}  {}".format(mode, "".join("({})".format(term) for term in terms), " ; ".join(actions))
+
+
+class _Timer:
+    """Times a stage, counting how many things it did and how many of them failed"""
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.count = 0
+        self.errors = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+
+        if exc_type is None and self.count and self.errors / self.count > MAX_ERROR_RATE:
+            raise Exception("Stage {} failed {} times out of {}".format(self.name, self.errors, self.count))
+
+        self.results[self.name] = {
+            "seconds": seconds,
+            "count": self.count,
+            "errors": self.errors,
+            "per_second": self.count / seconds if seconds > 0 and self.count else None,
+        }
+
+
+def run(path, lookups=10000, seed=0):
+    """Times every stage on the language at path once, returns {stage: {seconds, count, errors, per_second}}"""
+    results = {}
+
+    with _Timer(results, "ipa_table") as t:
+        IPA().ipa_to_phoneme("a")  # The first use reads the tables
+        t.count = 1
+
+    with _Timer(results, "language") as t:
+        lang = Language(path, use_snapshot=False)
+        t.count = 1
+
+    # Language does all of the stages below at once, they are timed again one at a time
+    with _Timer(results, "sources") as t:
+        Language._load_romanization(lang.file_path("romanization"))
+        lang._load_attributes(lang.file_path("attributes"))
+        t.count = len(lang._load_rules(lang.file_path("rules")).rules)
+
+    with _Timer(results, "dictionary_parse") as t:
+        entries = Language._parse_dictionary(lang.file_path("dictionary"))
+        t.count = len(entries)
+
+    with _Timer(results, "dictionary_load") as t:
+        lang.dictionary = Dictionary(lang)
+        lang.dictionary.load(entries)  # Derives every word too, to index them
+        t.count = len(lang.dictionary.words)
+
+    words = lang.dictionary.words
+    for word in words:
+        word.invalidate()
+
+    derived = []
+    with _Timer(results, "derive") as t:
+        for word in words:
+            try:
+                derived.append(word.phonemes)
+            except Exception:
+                t.errors += 1
+        t.count = len(words)
+
+    with _Timer(results, "syllabify") as t:
+        for phonemes in derived:
+            lang.syllable_data.syllables(phonemes)
+        t.count = len(derived)
+
+    rng = random.Random(seed)
+    texts = [word.morphemes[0].text for word in lang.dictionary.free_words.values()]
+    texts = [rng.choice(texts) for _ in range(lookups)] if texts else []
+
+    with _Timer(results, "index") as t:
+        lang.dictionary.reindex()  # Built by load already, this builds it again from the new derivations
+        t.count = len(words)
+
+    with _Timer(results, "lookup") as t:
+        for text in texts:
+            try:
+                lang.dictionary.get_word(text, raw=True)
+            except ValueError:
+                t.errors += 1
+        t.count = len(texts)
+
+    with _Timer(results, "kiershenbaum") as t:
+        for word in words:
+            try:
+                kiershenbaum.unicode_to_ascii(word.ipa)
+            except Exception:
+                t.errors += 1
+        t.count = len(words)
+
+    with _Timer(results, "romanization") as t:
+        for phonemes in derived:
+            try:
+                lang.romanization.phonemes_to_roman(phonemes)
+            except Exception:
+                t.errors += 1
+        t.count = len(derived)
+
+    return results
+
+
+def best(runs):
+    """The fastest time of every stage over several runs, to leave out noise from the rest of the machine"""
+    return {stage: min((results[stage] for results in runs), key=lambda result: result["seconds"])
+            for stage in runs[0]}
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Text table of how much slower (> 1) or faster (< 1) every stage of new is than the same run in old"""
+    old_runs = {json.dumps(run["config"], sort_keys=True): run for run in old["runs"]}
+    lines = []
+
+    for run in new["runs"]:
+        old_run = old_runs.get(json.dumps(run["config"], sort_keys=True))
+        if old_run is None:
+            continue
+
+        lines.append(", ".join("{}={}".format(k, v) for k, v in sorted(run["config"].items())))
+        for stage, result in run["stages"].items():
+            if stage in old_run["stages"] and old_run["stages"][stage]["seconds"] > 0:
+                ratio = result["seconds"] / old_run["stages"][stage]["seconds"]
+                lines.append("  {:<18} {:>10.4f}s {:>10.4f}s {:>7.2f}x{}".format(
+                    stage, old_run["stages"][stage]["seconds"], result["seconds"], ratio,
+                    "  slower" if ratio > 1.2 else ""))
+
+    return "\n".join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Times every stage of loading and using a language")
+    parser.add_argument("--lang", nargs="*", default=[], help="real languages to time, instead of made up ones")
+    parser.add_argument("--morphemes", nargs="*", type=int, default=[1000, 10000])
+    parser.add_argument("--rules", nargs="*", type=int, default=[10, 100])
+    parser.add_argument("--syllable", nargs="*", default=["(C)V(C)"])
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each, the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", help="folder to keep the made up languages in")
+    parser.add_argument("--out", help="file to write the JSON results to, instead of stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier version to compare to")
+    args = parser.parse_args(argv)
+
+    configs = [({"lang": path}, path) for path in args.lang]
+    folder = args.keep or tempfile.mkdtemp(prefix="lexicon_bench_")
+
+    if not args.lang:
+        for morphemes in args.morphemes:
+            for rules in args.rules:
+                for syllable in args.syllable:
+                    config = {"morphemes": morphemes, "rules": rules, "syllable": syllable, "seed": args.seed}
+                    path = os.path.join(folder, "m{}_r{}_{}".format(morphemes, rules, len(configs)))
+                    generate(path, morphemes, rules, syllable, seed=args.seed)
+                    configs.append((config, path))
+
+    runs = []
+    try:
+        for config, path in configs:
+            print("Running {}".format(config), file=sys.stderr)
+            stages = best([run(path, args.lookups, args.seed) for _ in range(args.repeat)])
+            runs.append({"config": config, "stages": stages})
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    results = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": args.repeat,
+        "runs": runs,
+    }
+    text = json.dumps(results, indent=1)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print(compare(json.load(f), results), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
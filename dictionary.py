@@ -1,46 +1,141 @@
-import bisect
 from typing import List
 
 from phoneme import Phonemes
+from rules import RuleTrace
 
 
 class Morpheme:
-    def __init__(self, prefix: Phonemes, postfix: Phonemes, definitions):
+    def __init__(self, prefix: Phonemes, postfix: Phonemes, definitions, text=None):
         self.prefix = prefix
         self.postfix = postfix
         self.definitions = definitions
+        self.text = text  # Romanized source, "pre-post"
+        self.version = 0
+
+    def update(self, prefix: Phonemes, postfix: Phonemes, definitions, text=None):
+        self.prefix = prefix
+        self.postfix = postfix
+        self.definitions = definitions
+        self.text = text
+        self.version += 1  # Invalidates the derivations of every word built from this morpheme
 
     def apply(self, ipa):
-        return self.prefix.copy() + ipa + self.postfix.copy()
+        return self.prefix + ipa + self.postfix  # Concatenation copies, the morpheme is left untouched
 
     def __str__(self):
         return "{}-{}".format(self.prefix, self.postfix)
 
 
+class Derivation:
+    def __init__(self, stamp, raw_phonemes: Phonemes, phonemes: Phonemes, trace: RuleTrace=None, ipa=None):
+        self.stamp = stamp
+        self.raw_phonemes = raw_phonemes
+        self.phonemes = phonemes
+        self.trace = trace
+        self.ipa = phonemes.ipa if ipa is None else ipa
+        self._sort_key = None
+
+    @property
+    def sort_key(self):
+        if self._sort_key is None:
+            self._sort_key = self.phonemes.sort_key()
+
+        return self._sort_key
+
+
 class Word:
     def __init__(self, lang, morphemes: List[Morpheme], definitions):
         self.lang = lang
         self.morphemes = morphemes
         self.definitions = definitions
 
+    @property
+    def morphemes(self) -> List[Morpheme]:
+        return self._morphemes
+
+    @morphemes.setter
+    def morphemes(self, morphemes: List[Morpheme]):
+        self._morphemes = morphemes
+        self.invalidate()
+
+    @property
+    def stamp(self):
+        # Changes whenever anything the derivation depends on changes, morphemes are compared by identity
+        return self.lang.version, tuple((morpheme, morpheme.version) for morpheme in self._morphemes)
+
+    def invalidate(self):
+        self._derivation = None
+        self._error = None
+
+    def build_raw_phonemes(self) -> Phonemes:
+        """The raw form put together from the morphemes, without deriving the word or using its cached derivation"""
+        raw = Phonemes()
+        for morpheme in self._morphemes:
+            raw = morpheme.apply(raw)
+        return raw
+
+    def is_derived(self):
+        """True if the cached derivation, or failure, is still current"""
+        stamp = self.stamp
+        return self._derivation is not None and self._derivation.stamp == stamp or \
+            self._error is not None and self._error[0] == stamp
+
+    def set_derivation(self, phonemes: Phonemes, trace: RuleTrace=None, raw_phonemes: Phonemes=None, ipa=None):
+        """Caches a surface form derived elsewhere, e.g. Language.derive_all. The rest is worked out if not given"""
+        raw_phonemes = self.build_raw_phonemes() if raw_phonemes is None else raw_phonemes
+        self._derivation = Derivation(self.stamp, raw_phonemes, phonemes, trace, ipa)
+        self._error = None
+
+    def restamp(self):
+        """Marks the cached derivation as current, for changes that are known not to affect this word"""
+        stamp = self.stamp
+
+        if self._derivation is not None:
+            self._derivation.stamp = stamp
+        if self._error is not None:
+            self._error = stamp, self._error[1]
+
+    @property
+    def trace(self) -> RuleTrace:
+        """How the rules were applied in the cached derivation, None if there isn't one"""
+        return self._derivation.trace if self._derivation is not None else None
+
+    def set_error(self, error: Exception):
+        self._derivation = None
+        self._error = self.stamp, error
+
+    @property
+    def derivation(self) -> Derivation:
+        stamp = self.stamp
+
+        if self._derivation is None or self._derivation.stamp != stamp:
+            if self._error is not None and self._error[0] == stamp:
+                raise self._error[1]  # Failed before, and nothing has changed since
+
+            raw = self.build_raw_phonemes()
+            trace = RuleTrace()
+
+            try:
+                ps = self.lang.derive(raw, trace)
+            except Exception as e:
+                self.set_error(e)  # Drops the old derivation too, restamp would otherwise make it current again
+                raise
+
+            self._derivation = Derivation(stamp, raw, ps, trace)
+
+        return self._derivation
+
     @property
     def phonemes(self) -> Phonemes:
-        ps = self.raw_phonemes
-        self.lang.syllable_data.stressify(ps)  # Solve stressing for rules
-        self.lang.rules.apply(ps)              # Apply phonetic rules
-        self.lang.syllable_data.stressify(ps)  # Reapply stressing, since syllables may have moved / changed
-        return ps
+        return self.derivation.phonemes[:]  # A view, changing it copies it and leaves the cached derivation alone
 
     @property
     def raw_phonemes(self) -> Phonemes:
-        ps = Phonemes()
-        for morpheme in self.morphemes:
-            ps = morpheme.apply(ps)
-        return ps
+        return self.derivation.raw_phonemes[:]
 
     @property
     def ipa(self):
-        return self.phonemes.ipa
+        return self.derivation.ipa
 
     def __lt__(self, other):
         if isinstance(other, Word):
@@ -48,18 +143,9 @@ class Word:
         if isinstance(other, Phonemes):
             return self.phonemes < other
         if isinstance(other, str):
-            for phoneme, char in zip(self.phonemes, other):
-                if phoneme < char:
-                    return True
-                elif char < phoneme:
-                    return False
+            return self.phonemes < self.lang.to_phonemes(other)
 
-            if len(self.phonemes) < other:
-                return True
-
-            return False
-
-        raise TypeError("Cannot compare {} with word".format(other.type))
+        raise TypeError("Cannot compare {} with word".format(type(other)))
 
     def __str__(self):
         return str(self.phonemes)
@@ -68,41 +154,322 @@ class Word:
 class Dictionary:
     def __init__(self, lang):
         self.lang = lang
+        self.version = 0  # Changes when a morpheme is redefined
         self._morphemes = {}
-        self._words = []
+        self._free_words = {}
+        self._words = []  # In the order they were added
+        self._positions = {}  # Word to the order it was added in
+
+        # Lookups and the sorted view are rebuilt lazily when the language or morphemes change
+        self._stamp = None
+        self._surface_index = None
+        self._raw_index = None
+        self._sorted_words = None
 
     def add_morpheme(self, tag: str, text, definitions):
+        morpheme = self._define_morpheme(tag, text, definitions)
+
+        if "-" not in text and tag in self._free_words:
+            self._free_words[tag].definitions = morpheme.definitions  # Like load and reload do
+        elif "-" not in text:  # check if free morpheme
+            self._free_words[tag] = self.add_word(self.to_word([tag], morpheme.definitions))
+        elif tag in self._free_words:
+            self.remove_word(self._free_words.pop(tag))
+
+        return morpheme
+
+    def _define_morpheme(self, tag: str, text, definitions):
+        pre, post = self._split_morpheme(text)
+
+        if tag in self._morphemes:  # Redefining a morpheme updates every word using it
+            morpheme = self._morphemes[tag]
+            morpheme.update(pre, post, definitions, text)
+            self.version += 1
+        else:
+            morpheme = Morpheme(pre, post, definitions, text)
+            self._morphemes[tag] = morpheme
+
+        return morpheme
+
+    def _split_morpheme(self, text):
         split = text.find("-")
         pre = self.lang.to_phonemes(text[:max(0, split)])
         post = self.lang.to_phonemes(text[split+1:])
+        return pre, post
 
-        morpheme = Morpheme(pre, post, definitions)
-        self._morphemes[tag] = morpheme
+    def load(self, entries, workers=1):
+        """
+        Bulk version of add_morpheme and add_word, every word is derived once and the dictionary is sorted once.
+        entries are (tag, text, definitions) for morphemes and (tags, definitions) for words, in the order they were
+        written. Words can use morphemes defined after them. See Language.derive_all for workers
+        """
+        for entry in entries:
+            if len(entry) == 3:
+                self._define_morpheme(*entry)
 
-        if split < 0:  # check if free morpheme
-            self.add_word(self.to_word([tag], morpheme.definitions))
+        words = []
+        for entry in entries:
+            if len(entry) == 3:
+                tag, text, _ = entry
+                if "-" not in text and tag not in self._free_words:
+                    word = self.to_word([tag], self.get_morpheme(tag).definitions)
+                    self._free_words[tag] = word
+                    words.append(word)
+            else:
+                words.append(self.to_word(*entry))
 
-        return morpheme
+        for word in words:
+            self._positions[word] = len(self._positions)
+        self._words.extend(words)
+
+        if workers != 1:
+            self.lang.derive_all(workers, words)
+
+        self.reindex()
+
+    def reload(self, entries):
+        """
+        Replaces the contents with entries, as given to load. Morphemes keep their identity by tag and words by their
+        tags, so derivations of anything that didn't change are kept. Nothing is changed if an entry is invalid
+        """
+        morpheme_entries = {}
+        for entry in entries:
+            if len(entry) == 3:
+                tag, text, definitions = entry
+                old = self._morphemes.get(tag)
+                pre, post = (old.prefix, old.postfix) if old is not None and old.text == text \
+                    else self._split_morpheme(text)
+                morpheme_entries[tag] = text, pre, post, definitions
+
+        for entry in entries:
+            if len(entry) == 2:
+                for tag in entry[0]:
+                    if tag not in morpheme_entries:
+                        raise Exception("Unknown morpheme '{}' in {}".format(tag, "+".join(entry[0])))
+
+        # Everything is valid, from here on nothing can fail
+        morphemes = {}
+        for tag, (text, pre, post, definitions) in morpheme_entries.items():
+            morpheme = self._morphemes.get(tag)
+
+            if morpheme is None:
+                morpheme = Morpheme(pre, post, definitions, text)
+            elif morpheme.text != text:
+                morpheme.update(pre, post, definitions, text)
+            else:
+                morpheme.definitions = definitions  # Doesn't change how anything is pronounced
+
+            morphemes[tag] = morpheme
+
+        old_words = {}
+        for word in self._words:
+            old_words.setdefault(tuple(map(id, word.morphemes)), []).append(word)
+
+        def reuse(tags, definitions):
+            morpheme_list = [morphemes[tag] for tag in tags]
+            same = old_words.get(tuple(map(id, morpheme_list)))
+
+            if same:
+                word = same.pop(0)
+                word.definitions = definitions
+                return word
+
+            return Word(self.lang, morpheme_list, definitions)
+
+        free_words = {}
+        words = []
+        for entry in entries:
+            if len(entry) == 3:
+                tag, text, _ = entry
+                if "-" not in text and tag not in free_words:
+                    free_words[tag] = reuse([tag], morphemes[tag].definitions)
+                    words.append(free_words[tag])
+            else:
+                words.append(reuse(*entry))
+
+        self._morphemes = morphemes
+        self._free_words = free_words
+        self._words = words
+        self._positions = {word: i for i, word in enumerate(words)}
+        self.version += 1
+        self._stamp = None
+
+    def restore(self, morphemes, free_words, words, sorted_words):
+        """Replaces the contents with ones that are already derived and sorted, see snapshot.read"""
+        self._morphemes = morphemes
+        self._free_words = free_words
+        self._words = words
+        self._positions = {word: i for i, word in enumerate(words)}
+        self._surface_index = {}
+        self._raw_index = {}
+        self._stamp = self._current_stamp()
+
+        for word in words:
+            self._index_word(word)
+
+        self._sorted_words = sorted_words
 
     def to_word(self, tags, definitions):
         morphemes = [self.get_morpheme(tag) for tag in tags]
         return Word(self.lang, morphemes, definitions)
 
     def add_word(self, word):
-        bisect.insort_left(self._words, word)
+        self._positions[word] = len(self._positions)
+        self._words.append(word)
+        self._sorted_words = None
+
+        if self._stamp == self._current_stamp():
+            self._index_word(word)
+
         return word
 
+    def remove_word(self, word):
+        self._words.remove(word)
+        del self._positions[word]
+        self._stamp = None
+
+    @property
+    def words(self) -> List[Word]:
+        """Every word in the order it was added, unlike iterating which sorts by pronunciation"""
+        return list(self._words)
+
+    @property
+    def morphemes(self):
+        """Morphemes by tag"""
+        return dict(self._morphemes)
+
+    @property
+    def free_words(self):
+        """Words made of a single free morpheme, by tag"""
+        return dict(self._free_words)
+
     def get_morpheme(self, tag):
         return self._morphemes[tag]
 
-    def get_word(self, text):
+    def get_words(self, text, raw=False) -> List[Word]:
+        """All words pronounced as text, most recently added last. raw looks words up before rules are applied"""
+        self._update()
         phonemes = self.lang.to_phonemes(text)
-        i = bisect.bisect_left(self._words, phonemes)
+        index = self._raw_index if raw else self._surface_index
+        return list(index.get(phonemes.key(), ()))
+
+    def get_word(self, text, raw=False):
+        words = self.get_words(text, raw)
+
+        if words:
+            return words[-1]
+
+        raise ValueError("Cannot find {} ({})".format(text, self.lang.to_phonemes(text)))
+
+    def reindex(self):
+        """Builds the lookup indexes and the sorted order again from scratch, deriving any word that isn't yet"""
+        self._stamp = None
+        self._update()
 
-        if i != len(self._words) and self._words[i].phonemes == phonemes:
-            return self._words[i]
+    def _current_stamp(self):
+        return self.lang.version, self.version
 
-        raise ValueError("Cannot find {} ({})".format(text, phonemes))
+    def _update(self):
+        stamp = self._current_stamp()
+
+        if self._stamp != stamp:
+            self._surface_index = {}
+            self._raw_index = {}
+            self._sorted_words = None
+            self._stamp = stamp
+
+            for word in self._words:
+                self._index_word(word)
+
+            self._sort()
+
+    def _index_word(self, word):
+        try:
+            derivation = word.derivation
+        except Exception:
+            return  # Words that can't be derived can't be looked up
+
+        for index, phonemes in [(self._surface_index, derivation.phonemes), (self._raw_index, derivation.raw_phonemes)]:
+            words = index.setdefault(phonemes.key(), [])
+            words.append(word)
+
+            if len(words) > 1 and self._positions[words[-2]] > self._positions[word]:
+                words.sort(key=self._positions.__getitem__)  # Only when a word is indexed again after changing
+
+    def _unindex_word(self, word, derivation):
+        for index, phonemes in [(self._surface_index, derivation.phonemes), (self._raw_index, derivation.raw_phonemes)]:
+            words = index.get(phonemes.key(), [])
+
+            if word in words:
+                words.remove(word)
+
+    def rederive(self, change, affected=None):
+        """
+        Makes a change to the language or its morphemes with change(), then brings the derived words up to date.
+        Only words that affected(word) says could be different are derived again, None means every word.
+        Returns (word, old phonemes, new phonemes) for every word whose pronunciation changed
+        """
+        index_current = self._stamp == self._current_stamp()
+        before = set(self._words)
+        derived = [word for word in self._words if word.is_derived()]
+
+        change()
+
+        stale = []
+        after = set(self._words)
+        for word in derived:
+            if word not in after:
+                continue  # Removed by the change
+            if affected is None or affected(word):
+                stale.append((word, word._derivation))
+            else:
+                word.restamp()
+
+        stale.extend((word, None) for word in self._words if word not in before)  # Added by the change
+        self.lang.derive_all(self.lang.workers, [word for word, _ in stale])
+
+        changes = []
+        for word, old in stale:
+            new = word._derivation
+            old_phonemes = old.phonemes if old is not None else None
+            new_phonemes = new.phonemes if new is not None else None
+
+            if old_phonemes is None and new_phonemes is None and word in before:
+                pass  # Failed before the change and still does
+            elif old_phonemes is None or new_phonemes is None or old_phonemes.codes != new_phonemes.codes:
+                changes.append((word, old_phonemes, new_phonemes))
+
+            if index_current and self._stamp is not None:
+                if old is not None:
+                    self._unindex_word(word, old)
+                self._index_word(word)
+
+        if index_current and self._stamp is not None:
+            self._stamp = self._current_stamp()  # Every other word is known to be unaffected
+
+        if changes:
+            self._sorted_words = None
+
+        return changes
+
+    @staticmethod
+    def _sort_key(word):
+        try:
+            return 0, word.derivation.sort_key
+        except Exception:
+            return 1,  # Words that can't be derived go last
+
+    def _sort(self):
+        # Reversed so that equal words are most recent first, as if each was inserted before its equals
+        self._sorted_words = sorted(reversed(self._words), key=self._sort_key)
 
     def __iter__(self):
-        return iter(self._words)
\ No newline at end of file
+        self._update()
+
+        if self._sorted_words is None:
+            self._sort()
+
+        return iter(self._sorted_words)
+
+    def __len__(self):
+        return len(self._words)
@@ -17,9 +17,118 @@
 # limitations under the License.
 #
 
+import collections
+import concurrent.futures
 import logging
+import re
+import struct
 import subprocess
-import tempfile
+import threading
+
+
+# Punctuation that espeak-ng ends a clause at, and newlines
+_CLAUSE_END = re.compile(u'[.,;:!?\u00a1\u00bf\u2026\u3001\u3002\uff01\uff0c\uff1a\uff1b\uff1f\n\r]+')
+
+
+def _fix_wav_sizes(wav, size):
+    """Fills in the RIFF and data sizes at the start of wav, for a WAV that is size bytes long in total"""
+    data = wav.find(b'data', 12)
+    if not wav.startswith(b'RIFF') or data < 0 or len(wav) < data + 8:
+        return wav
+
+    return wav[:4] + struct.pack('<I', size - 8) + wav[8:data + 4] + struct.pack('<I', size - data - 8) + wav[data + 8:]
+
+
+class ESpeakPool(object):
+    """
+    espeak-ng takes a while to start and load its voice, so this keeps processes started ahead of time for the
+    commands that are used, waiting to read their text from stdin (--stdin). A request takes a waiting process and
+    another one is started for the next request, so there are as many waiting as requests ran at once, at most size
+    in all. At most size requests run at once, others wait for one to finish.
+    """
+    def __init__(self, size=2):
+        self.size = size
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._waiting = collections.OrderedDict()  # Command to processes started with it, least recently used first
+
+    @staticmethod
+    def _spawn(cmd, stderr):
+        logging.debug('espeakng: starting %s' % repr(cmd))
+        return subprocess.Popen(cmd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=stderr)
+
+    def start(self, cmd, text, stderr=subprocess.STDOUT, warm=True):
+        """
+        Starts espeak-ng with cmd and text, call release() once the returned process is finished with.
+        warm=False doesn't start one ahead for the next request, for commands that are only used once
+        """
+        key = tuple(cmd), stderr
+        self._slots.acquire()
+
+        try:
+            with self._lock:
+                waiting = self._waiting.get(key)
+                p = waiting.pop() if waiting else None
+                if waiting is not None and not waiting:
+                    del self._waiting[key]
+
+            if p is not None and p.poll() is not None:
+                self._stop(p)
+                p = None
+
+            if p is None:
+                p = self._spawn(cmd, stderr)
+
+            p.stdin.write(text.encode('utf8'))
+            p.stdin.close()
+
+            if warm:  # Ready for the next request while this one is working
+                self._add(key, self._spawn(cmd, stderr))
+        except Exception:
+            self._slots.release()
+            raise
+
+        return p
+
+    def _add(self, key, p):
+        stop = []
+
+        with self._lock:
+            self._waiting.setdefault(key, []).append(p)
+            self._waiting.move_to_end(key)
+
+            # Concurrent requests can start more than are needed, the longest waiting ones go
+            while sum(map(len, self._waiting.values())) > self.size:
+                oldest = next(iter(self._waiting.values()))
+                stop.append(oldest.pop(0))
+                if not oldest:
+                    self._waiting.popitem(last=False)
+
+        for p in stop:
+            self._stop(p)
+
+    def release(self):
+        self._slots.release()
+
+    def clear(self):
+        """Stops the waiting processes, e.g. after the settings they were started with changed"""
+        with self._lock:
+            waiting = [p for waiting in self._waiting.values() for p in waiting]
+            self._waiting.clear()
+
+        for p in waiting:
+            self._stop(p)
+
+    @staticmethod
+    def _stop(p):
+        p.kill()
+        for f in (p.stdin, p.stdout, p.stderr):
+            if f:
+                f.close()
+        p.wait()
 
 
 class ESpeakNG(object):
@@ -33,7 +142,9 @@ class ESpeakNG(object):
                  line_length=0,  # Line length. If not zero, consider lines less than this length as end-of-clause
                  pitch=50,  # 0-99
                  speed=175,  # approx. words per minute
-                 voice='en-us'):
+                 voice='en-us',
+                 executable='espeak-ng',
+                 workers=0):  # If not zero, use an ESpeakPool of this size
 
         self._volume = volume
         self._audio_dev = audio_dev
@@ -43,9 +154,66 @@ class ESpeakNG(object):
         self._pitch = pitch
         self._speed = speed
         self._voice = voice
+        self.executable = executable
+        self._pool = ESpeakPool(workers) if workers else None
+        self._voices = None
+
+    @property
+    def settings(self):
+        """Everything that changes how text sounds"""
+        return {
+            'volume': self._volume,
+            'word_gap': self._word_gap,
+            'capitals': self._capitals,
+            'line_length': self._line_length,
+            'pitch': self._pitch,
+            'speed': self._speed,
+            'voice': self._voice,
+        }
+
+    def _changed(self):
+        if self._pool:
+            self._pool.clear()  # Waiting processes have the old settings
+
+    def close(self):
+        """Stops the espeak-ng processes the pool started ahead of time"""
+        if self._pool:
+            self._pool.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _espeak_exe(self, args, sync=False, text=None, warm=True):
+        """Runs espeak-ng with args, text is sent on stdin. Returns the lines of output if sync"""
+        p, pooled = self._start(args, text, warm=warm)
+
+        try:
+            res = iter(p.stdout.readline, b'')
+            if not sync:
+                p.stdout.close()
+                return res
+
+            res2 = []
+            for line in res:
+                res2.append(line)
 
-    def _espeak_exe(self, args, sync=False):
-        cmd = ['espeak-ng',
+            p.stdout.close()
+            p.wait()
+        finally:
+            if pooled:
+                self._pool.release()
+
+        return res2
+
+    def _start(self, args, text=None, stderr=subprocess.STDOUT, warm=True):
+        """
+        Starts espeak-ng, returns the process and if it came from the pool, which then has to be released.
+        warm is passed on to ESpeakPool.start
+        """
+        cmd = [self.executable,
                '-a', str(self._volume),
                '-k', str(self._capitals),
                '-l', str(self._line_length),
@@ -60,35 +228,24 @@ class ESpeakNG(object):
 
         cmd.extend(args)
 
-        logging.debug('espeakng: executing %s' % repr(cmd))
-
-        # '-w', f.name, s
+        if text is not None:
+            cmd.append('--stdin')
 
-        p = subprocess.Popen(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
+        logging.debug('espeakng: executing %s' % repr(cmd))
 
-        res = iter(p.stdout.readline, b'')
-        if not sync:
-            p.stdout.close()
-            if p.stderr:
-                p.stderr.close()
-            if p.stdin:
+        pooled = bool(self._pool and text is not None)
+        if pooled:
+            p = self._pool.start(cmd, text, stderr, warm)
+        else:
+            p = subprocess.Popen(cmd,
+                                 stdin=subprocess.PIPE if text is not None else None,
+                                 stdout=subprocess.PIPE,
+                                 stderr=stderr)
+            if text is not None:
+                p.stdin.write(text.encode('utf8'))
                 p.stdin.close()
-            return res
 
-        res2 = []
-        for line in res:
-            res2.append(line)
-
-        p.stdout.close()
-        if p.stderr:
-            p.stderr.close()
-        if p.stdin:
-            p.stdin.close()
-        p.wait()
-
-        return res2
+        return p, pooled
 
     def say(self, txt, sync=False, ipa=False):
 
@@ -99,36 +256,81 @@ class ESpeakNG(object):
         if self._audio_dev:
             args.extend(['-d', self._audio_dev])
 
-        args.append(txte)
+        return self._espeak_exe(args, sync=sync, text=txte)
+
+    @staticmethod
+    def _format(txt, fmt):
+        if fmt == 'xs':
+            return '[[' + txt + ']]'
+        elif fmt != 'txt':
+            raise Exception('unknown format: %s' % fmt)
 
-        return self._espeak_exe(args, sync=sync)
+        return txt
 
     def synth_wav(self, txt, fmt='txt'):
+        wav = b''.join(self.synth_wav_stream(txt, fmt))
 
-        wav = None
+        logging.debug('synthesized %d bytes.' % len(wav))
 
-        with tempfile.NamedTemporaryFile() as f:
+        return _fix_wav_sizes(wav, len(wav))
 
-            if fmt == 'xs':
-                txt = '[[' + txt + ']]'
-            elif fmt != 'txt':
-                raise Exception('unknown format: %s' % fmt)
+    def synth_wav_stream(self, txt, fmt='txt', out=None, chunk_size=65536):
+        """
+        Synthesizes txt, yielding the WAV in chunks as espeak-ng makes them, so it can be played before it's finished.
+        The sizes in the header are only placeholders, since they aren't known yet.
+        If out is given, the WAV is written to it instead and its size is returned, and if out can seek, the header
+        is fixed afterwards
+        """
+        chunks = self._synth_chunks(self._format(txt, fmt), chunk_size)
 
-            txte = txt.encode('utf8')
+        if out is None:
+            return chunks
 
-            args = ['-w', f.name, txte]
+        start = out.tell() if out.seekable() else None
+        header = b''
+        size = 0
 
-            self._espeak_exe(args, sync=True)
+        for chunk in chunks:
+            if len(header) < 64:
+                header += chunk[:64]
+            out.write(chunk)
+            size += len(chunk)
 
-            f.seek(0)
-            wav = f.read()
+        if start is not None and size:
+            end = out.tell()
+            out.seek(start)
+            out.write(_fix_wav_sizes(header, size))
+            out.seek(end)
 
-            logging.debug('read %s, got %d bytes.' % (f.name, len(wav)))
+        return size
 
-        return wav
+    def _synth_chunks(self, txt, chunk_size):
+        p, pooled = self._start(['--stdout'], txt, stderr=subprocess.PIPE)
 
-    def g2p(self, txt, ipa=None, tie=None):
+        try:
+            while True:
+                chunk = p.stdout.read1(chunk_size)
+                if not chunk:
+                    break
+
+                yield chunk
+
+            error = p.stderr.read()
+            if p.wait() != 0:
+                raise Exception('espeak-ng exited with %d: %s' % (p.returncode, error.decode('utf8', 'replace').strip()))
+        finally:
+            if p.returncode is None:  # Stopped early
+                p.kill()
+                p.wait()
 
+            p.stdout.close()
+            p.stderr.close()
+
+            if pooled:
+                self._pool.release()
+
+    @staticmethod
+    def _g2p_args(ipa, tie):
         args = ['-q']
 
         if ipa:
@@ -139,19 +341,84 @@ class ESpeakNG(object):
         if tie:
             args.append('--tie=%s' % tie)
 
-        args.append(txt)
+        return args
+
+    def g2p(self, txt, ipa=None, tie=None):
+
+        args = self._g2p_args(ipa, tie)
 
         phonemes = u''
 
-        for line in self._espeak_exe(args, sync=True):
+        for line in self._espeak_exe(args, sync=True, text=txt):
             logging.debug(u'line: %s' % repr(line))
 
             phonemes += line.decode('utf8').strip()
 
         return phonemes
 
+    def g2p_batch(self, texts, ipa=None, tie=None, batch_size=1000):
+        """
+        Same as g2p for each of texts, but with one espeak-ng process for every batch_size of them. espeak-ng gives
+        each clause its own line, so texts with clause punctuation or newlines in them go through g2p one at a time
+        """
+        results = [u''] * len(texts)
+        items = []
+
+        for i, txt in enumerate(texts):
+            if _CLAUSE_END.search(txt):
+                results[i] = self.g2p(txt, ipa, tie)  # "3.5" or "1,000" could be said differently if split up
+            elif txt.strip():
+                items.append(i)  # Blank lines don't give a line of phonemes
+
+        texts = [u' '.join(txt.split()) for txt in texts]
+
+        for start in range(0, len(items), batch_size):
+            self._g2p_batch(texts, items[start:start + batch_size], results, self._g2p_args(ipa, tie))
+
+        return results
+
+    def _g2p_batch(self, texts, items, results, args):
+        # Lines shorter than -l end a clause, so every text gets exactly one line of phonemes. -l is different for
+        # nearly every batch, so no process is started ahead for the next one
+        length = max(len(texts[i]) for i in items) + 1
+        lines = self._espeak_exe(args + ['-l', str(length)], sync=True, text=u'\n'.join(texts[i] for i in items),
+                                 warm=False)
+
+        if len(lines) == len(items):
+            for i, line in zip(items, lines):
+                results[i] = line.decode('utf8').strip()
+        elif len(items) == 1:  # espeak-ng split it up anyway, e.g. a very long text
+            results[items[0]] = u''.join(line.decode('utf8').strip() for line in lines)
+        else:
+            logging.debug('espeakng: g2p_batch got %d lines for %d texts, splitting' % (len(lines), len(items)))
+            half = len(items) // 2
+            self._g2p_batch(texts, items[:half], results, args)
+            self._g2p_batch(texts, items[half:], results, args)
+
+    def synth_batch(self, texts, fmt='txt'):
+        """
+        synth_wav for each of texts, returned in the same order. espeak-ng gives no way to split one WAV back up, so
+        each is a separate process, running as many at once as the pool allows
+        """
+        if not self._pool:
+            return [self.synth_wav(txt, fmt) for txt in texts]
+
+        with concurrent.futures.ThreadPoolExecutor(self._pool.size) as executor:
+            return list(executor.map(lambda txt: self.synth_wav(txt, fmt), texts))
+
     @property
     def voices(self):
+        """Installed voices, only asked for the first time, see invalidate_voices"""
+        if self._voices is None:
+            self._voices = self._load_voices()
+
+        return list(self._voices)
+
+    def invalidate_voices(self):
+        """Forgets the voices, e.g. after installing more"""
+        self._voices = None
+
+    def _load_voices(self):
 
         res = self._espeak_exe(['--voices'], sync=True)
 
@@ -196,6 +463,7 @@ class ESpeakNG(object):
     @volume.setter
     def volume(self, v):
         self._volume = v
+        self._changed()
 
     @property
     def audio_dev(self):
@@ -204,6 +472,7 @@ class ESpeakNG(object):
     @audio_dev.setter
     def audio_dev(self, v):
         self._audio_dev = v
+        self._changed()
 
     @property
     def word_gap(self):
@@ -212,6 +481,7 @@ class ESpeakNG(object):
     @word_gap.setter
     def word_gap(self, v):
         self._word_gap = v
+        self._changed()
 
     @property
     def capitals(self):
@@ -220,6 +490,7 @@ class ESpeakNG(object):
     @capitals.setter
     def capitals(self, v):
         self._capitals = v
+        self._changed()
 
     @property
     def line_length(self):
@@ -228,6 +499,7 @@ class ESpeakNG(object):
     @line_length.setter
     def line_length(self, v):
         self._line_length = v
+        self._changed()
 
     @property
     def pitch(self):
@@ -236,6 +508,7 @@ class ESpeakNG(object):
     @pitch.setter
     def pitch(self, v):
         self._pitch = v
+        self._changed()
 
     @property
     def speed(self):
@@ -244,6 +517,7 @@ class ESpeakNG(object):
     @speed.setter
     def speed(self, v):
         self._speed = v
+        self._changed()
 
     @property
     def voice(self):
@@ -252,3 +526,4 @@ class ESpeakNG(object):
     @voice.setter
     def voice(self, v):
         self._voice = v
+        self._changed()
@@ -0,0 +1,133 @@
+"""
+Exports how every word in a language sounds, as one WAV per word and a manifest.json listing the words, to a folder or
+an uncompressed zip. Exporting again only synthesizes the words that sound different, or were said with other settings.
+
+    python export.py lang1 lang1_audio
+    python export.py lang1 lang1_audio.zip
+"""
+import json
+import os
+import shutil
+import sys
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from language import Language
+from tts import TTS
+from wavcache import WavCache
+
+MANIFEST = "manifest.json"
+
+
+def export(lang: Language, tts: TTS, path, workers=4):
+    """
+    Exports lang to path, which is a zip if it ends with .zip and a folder otherwise. Up to workers words are
+    synthesized at once. Returns how many WAVs were synthesized and how many were kept from the last export
+    """
+    lang.derive_all(lang.workers)
+    tags = {morpheme: tag for tag, morpheme in lang.dictionary.morphemes.items()}
+
+    entries = []
+    wavs = {}
+    for word in lang.dictionary:
+        entry = {
+            "tags": [tags[morpheme] for morpheme in word.morphemes],
+            "definitions": word.definitions,
+        }
+        entries.append(entry)
+
+        try:
+            entry["romanization"] = lang.romanization.phonemes_to_roman(word.phonemes)
+            entry["raw_romanization"] = lang.romanization.phonemes_to_roman(word.raw_phonemes)
+            entry["ipa"] = word.ipa
+            kiershenbaum = tts.ipa_to_kiershenbaum(word.ipa)
+        except Exception as e:
+            entry["error"] = str(e)
+            continue
+
+        # Words that would sound the same share a file, named by everything that changes how it sounds
+        entry["file"] = WavCache.key(kiershenbaum, "xs", tts.espeakng.settings)[:32] + ".wav"
+        wavs[entry["file"]] = kiershenbaum
+
+    manifest = json.dumps({"words": entries, "settings": tts.espeakng.settings}, indent=1, ensure_ascii=False)
+
+    if path.endswith(".zip"):
+        return _export_zip(tts, path, wavs, manifest, workers)
+
+    return _export_folder(tts, path, wavs, manifest, workers)
+
+
+def _synthesize(tts, wavs, workers):
+    """Yields (file, wav) for every one of wavs (file to kiershenbaum), synthesizing workers at a time"""
+    with ThreadPoolExecutor(workers) as executor:
+        names = list(wavs)
+        yield from zip(names, executor.map(tts.synth_kiershenbaum, (wavs[name] for name in names)))
+
+
+def _export_folder(tts, path, wavs, manifest, workers):
+    os.makedirs(path, exist_ok=True)
+
+    for name in os.listdir(path):
+        if name.endswith(".wav.tmp"):
+            os.remove(os.path.join(path, name))  # Left by an export that was interrupted
+
+    # Only files the last export made are reused or deleted, anything else in the folder is left alone
+    existing = {name for name in _manifest_files(os.path.join(path, MANIFEST))
+                if os.path.exists(os.path.join(path, name))}
+    missing = {name: kiershenbaum for name, kiershenbaum in wavs.items() if name not in existing}
+
+    for name, wav in _synthesize(tts, missing, workers):
+        temp_path = os.path.join(path, name + ".tmp")  # A WAV that is there is always complete
+        with open(temp_path, "wb") as f:
+            f.write(wav)
+        os.replace(temp_path, os.path.join(path, name))
+
+    for name in existing - set(wavs):
+        os.remove(os.path.join(path, name))  # Words that changed or were removed
+
+    with open(os.path.join(path, MANIFEST), "w", encoding="utf-8") as f:
+        f.write(manifest)
+
+    return len(missing), len(wavs) - len(missing)
+
+
+def _manifest_files(path):
+    """Every file listed in the manifest at path, which might not exist"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            words = json.load(f)["words"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return set()
+
+    return {word["file"] for word in words if "file" in word}
+
+
+def _export_zip(tts, path, wavs, manifest, workers):
+    old = zipfile.ZipFile(path) if os.path.exists(path) else None
+    existing = set(old.namelist()) if old is not None else set()
+    missing = {name: kiershenbaum for name, kiershenbaum in wavs.items() if name not in existing}
+
+    temp_path = path + ".tmp"
+    try:
+        with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_STORED) as new:
+            for name in wavs:
+                if name in existing:
+                    with old.open(name) as src, new.open(name, "w") as dst:
+                        shutil.copyfileobj(src, dst)
+
+            for name, wav in _synthesize(tts, missing, workers):
+                new.writestr(name, wav)
+
+            new.writestr(MANIFEST, manifest)
+    finally:
+        if old is not None:
+            old.close()
+
+    os.replace(temp_path, path)
+
+    return len(missing), len(wavs) - len(missing)
+
+
+if __name__ == "__main__":
+    synthesized, kept = export(Language(sys.argv[1]), TTS(workers=4), sys.argv[2])
+    print("Synthesized {}, kept {}".format(synthesized, kept))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Stand-in for espeak-ng, for trying out the TTS code without espeak-ng or any audio hardware:
+
+    ESpeakNG(executable="./fake_espeak_ng.py")
+
+It takes the same arguments that espeakng.py uses. Phonemes (-x, --ipa) are just the lowercased text, one line per
+clause like espeak-ng. Audio (-w, --stdout) is a short WAV made from the text and settings, and speaking waits a moment
+instead of playing anything. Environment variables:
+
+    FAKE_ESPEAK_STARTUP   seconds to wait before reading any text, like espeak-ng loading its voice (default 0.03)
+    FAKE_ESPEAK_SPEAK     seconds per character to "speak" for (default 0.001)
+    FAKE_ESPEAK_LOG       file to append a line to for everything synthesized, to count calls
+"""
+import hashlib
+import os
+import re
+import struct
+import sys
+import time
+
+VOICES = [
+    ("5", "af", "M", "Afrikaans", "gmw/af"),
+    ("5", "en", "M", "English_(Great_Britain)", "gmw/en"),
+    ("5", "en-us", "M", "English_(America)", "gmw/en-US"),
+    ("5", "eo", "M", "Esperanto", "art/eo"),
+]
+
+SAMPLE_RATE = 22050
+STREAM_SIZE = 0x7ffff000  # What espeak-ng puts in the header when it doesn't know the length yet
+
+VALUE_OPTIONS = {"-a", "-k", "-l", "-p", "-s", "-v", "-b", "-g", "-d", "-w"}
+
+
+def parse(argv):
+    options = {}
+    text = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in VALUE_OPTIONS:
+            options[arg] = argv[i + 1]
+            i += 1
+        elif arg.startswith("--") and "=" in arg:
+            key, value = arg.split("=", 1)
+            options[key] = value
+        elif arg.startswith("-"):
+            options[arg] = True
+        else:
+            text = arg
+        i += 1
+    return options, text
+
+
+def wav_header(data_size):
+    return b"RIFF" + struct.pack("<I", min(data_size + 36, 0xffffffff)) + b"WAVE" + \
+        b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, SAMPLE_RATE, SAMPLE_RATE * 2, 2, 16) + \
+        b"data" + struct.pack("<I", data_size)
+
+
+def samples(text, options):
+    # Deterministic, so the same text and settings always sound the same
+    seed = hashlib.sha1(repr((text, sorted(options.items()))).encode("utf-8")).digest()
+    count = max(1, len(text)) * 20000 // int(options.get("-s", 175))
+    return (seed * (count * 2 // len(seed) + 1))[:count * 2]
+
+
+def log(text, options):
+    path = os.environ.get("FAKE_ESPEAK_LOG")
+    if path:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("{}\t{}\n".format(" ".join(sorted(k for k in options if k != "--stdin")), text.replace("\n", " ")))
+
+
+def main(argv):
+    options, text = parse(argv)
+    out = sys.stdout.buffer
+
+    if "--voices" in options:
+        out.write(b"Pty Language       Age/Gender VoiceName          File                 Other Languages\n")
+        for pty, language, gender, name, file in VOICES:
+            out.write("{:>2}  {:<15}--/{}      {:<18} {}\n".format(pty, language, gender, name, file).encode("utf-8"))
+        return 0
+
+    time.sleep(float(os.environ.get("FAKE_ESPEAK_STARTUP", "0.03")))
+
+    if text is not None:
+        texts = [text]
+    elif "--stdin" in options:
+        texts = [sys.stdin.buffer.read().decode("utf-8")]
+    else:
+        texts = (line.decode("utf-8") for line in sys.stdin.buffer)  # A line at a time, as they come
+
+    if "--stdout" in options:
+        out.write(wav_header(STREAM_SIZE))
+
+    for text in texts:
+        log(text, options)
+
+        if "-x" in options or "--ipa" in options:
+            for clause in re.split(r"[.,;:!?\n]+", text):
+                if clause.strip():
+                    out.write(" {}\n".format(clause.strip().lower()).encode("utf-8"))
+        elif "--stdout" in options:
+            data = samples(text, options)
+            for i in range(0, len(data), 4096):
+                out.write(data[i:i + 4096])
+        elif "-w" in options:
+            data = samples(text, options)
+            with open(options["-w"], "wb") as f:
+                f.write(wav_header(len(data)) + data)
+        elif "-q" not in options:
+            time.sleep(len(text) * float(os.environ.get("FAKE_ESPEAK_SPEAK", "0.001")))
+
+        out.flush()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
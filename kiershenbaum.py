@@ -188,68 +188,110 @@ INVDIA = _sort([(b, a) for (a, b) in
 INVSEGLIST = _sort((b, a) for (a, b) in SEGLIST)
 
 
+VOWEL_SEGS = [seg in VOWELS for seg, uni in SEGLIST]
+DIACRITIC_TILDE = {True: dict(DIACRITICS_VOWEL)['~'], False: dict(DIACRITICS_CONSONANT)['~']}
+
+
+def _trie(table):
+    """Trie of the keys in table, each node is (children, indices in table of the keys that end there)"""
+    root = ({}, [])
+    for i, (key, _) in enumerate(table):
+        node = root
+        for char in key:
+            node = node[0].setdefault(char, ({}, []))
+        node[1].append(i)
+    return root
+
+
+SEG_TRIE = _trie(SEGLIST)
+DIACRITICS_TRIE = _trie(DIACRITICS)
+INVSEG_TRIE = _trie(INVSEGLIST)
+INVDIA_TRIE = _trie(INVDIA)
+
+
+def _scan(s, i, table, trie, t):
+    """
+    Same as going through table in order, and consuming each key that s starts with at i, but only looks at the keys
+    that can match. Returns the new i, and the index in table of the last key consumed or None
+    """
+    last = -1
+    while True:
+        # The next key consumed is the first one after the last that matches, out of all keys that match here
+        found = None
+        node = trie
+        j = i
+        while node is not None:
+            for index in node[1]:
+                if index > last:
+                    if found is None or index < found:
+                        found = index
+                    break
+
+            node = node[0].get(s[j]) if j < len(s) else None
+            j += 1
+
+        if found is None:
+            return i, (last if last >= 0 else None)
+
+        key, value = table[found]
+        t.append(value)
+        i += len(key)
+        last = found
+
+
 def ascii_to_unicode(s):
     """ASCII-IPA to Unicode IPA. Note: because of the simple syntax, the peculiar control flow is fine."""
     vowel = True
-    t = u''
-    lasts = ''
-    while s:
+    t = []
+    i = 0
+    lasti = None
+    while i < len(s):
         # Guarantees progress
-        if lasts == s:
-            t += s[0]
-            s = s[1:]
-        lasts = s
+        if lasti == i:
+            t.append(s[i])
+            i += 1
+        lasti = i
 
-        if s[0] in STRESS:
-            t += STRESS[s[0]]
-            s = s[1:]
+        if i == len(s):
+            break
 
-        for seg, uni in SEGLIST:
-            if s.startswith(seg):
-                s = s[len(seg):]
-                t += uni
-                vowel = seg in VOWELS
+        if s[i] in STRESS:
+            t.append(STRESS[s[i]])
+            i += 1
 
-        for dia, uni in DIACRITICS:
-            if s.startswith(dia):
-                s = s[len(dia):]
-                t += uni
+        i, seg = _scan(s, i, SEGLIST, SEG_TRIE, t)
+        if seg is not None:
+            vowel = VOWEL_SEGS[seg]
 
-        if s and s[0] == '~':
-            t += DIACRITICS_VOWEL['~'] if vowel else DIACRITICS_CONSONANT['~']
-            s = s[1:]
+        i, _ = _scan(s, i, DIACRITICS, DIACRITICS_TRIE, t)
 
-    return t
+        if i < len(s) and s[i] == '~':
+            t.append(DIACRITIC_TILDE[vowel])
+            i += 1
+
+    return u''.join(t)
 
 
 def unicode_to_ascii(s):
     """Unicode IPA to ASCII-IPA"""
-    vowel = True
-    t = ''
-    lasts = u''
-    while s:
+    t = []
+    i = 0
+    lasti = None
+    while i < len(s):
         # Guarantees progress
-        if lasts == s:
-            t += s[0]
-            s = s[1:]
-        lasts = s
+        if lasti == i:
+            t.append(s[i])
+            i += 1
+        lasti = i
 
-        if not s:
+        if i == len(s):
             break
 
-        if s[0] in INVSTRESS:
-            t += INVSTRESS[s[0]]  # bytes(INVSTRESS[s[0]], encoding="utf-8")
-            s = s[1:]
-
-        for seg, uni in INVSEGLIST:
-            if s.startswith(seg):
-                s = s[len(seg):]
-                t += uni
-                vowel = seg in INVVOW
+        if s[i] in INVSTRESS:
+            t.append(INVSTRESS[s[i]])
+            i += 1
 
-        for dia, uni in INVDIA:
-            if s.startswith(dia):
-                s = s[len(dia):]
-                t += uni
+        i, _ = _scan(s, i, INVSEGLIST, INVSEG_TRIE, t)
+        i, _ = _scan(s, i, INVDIA, INVDIA_TRIE, t)
 
-    return t
+    return ''.join(t)
@@ -1,9 +1,10 @@
+import os
 from typing import List
 
-from phoneme import Ipa, Phonemes, Stress, Length
+from phoneme import Ipa, Phonemes, Stress, Length, VOWEL_COUNT
 from dictionary import Dictionary
-from rules import Rule, RuleSet
-import re
+from rules import Rule, RuleProfile, RuleSet, RuleTrace
+import snapshot
 
 
 class Romanization:
@@ -19,7 +20,7 @@ class Romanization:
         phonemes = []
         for char in roman:
             if char in self.mapping:
-                phonemes.append(self.mapping[char].copy())
+                phonemes.append(self.mapping[char])
             else:
                 raise Exception("Unmapped char '{}' in {}".format(char, roman))
 
@@ -59,98 +60,400 @@ class Romanization:
 
 class SyllableData:
     def __init__(self, opt_onsets, req_onsets, opt_codas, req_codas, prime_stress, second_stress):
-        regex = "^(c{{{},{}}}vc{{{},{}}}?)+$".format(req_onsets, req_onsets + opt_onsets,
-                                                     req_codas, req_codas + opt_codas)
-        self.syllable_regex = re.compile(regex)
-        self.primary_stress = prime_stress
-        self.secondary_stress = second_stress
+        self.min_onsets = req_onsets
+        self.max_onsets = req_onsets + opt_onsets
+        self.min_codas = req_codas
+        self.max_codas = req_codas + opt_codas
+        self._stress_expressions = prime_stress, second_stress
+        self.primary_stress = self.compile_stress(prime_stress)
+        self.secondary_stress = self.compile_stress(second_stress)
+        self._stress_patterns = {}
+
+    def __getstate__(self):
+        # Compiled stress functions can't be pickled, the expressions are compiled again on the other side
+        state = self.__dict__.copy()
+        del state["primary_stress"]
+        del state["secondary_stress"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.primary_stress = self.compile_stress(self._stress_expressions[0])
+        self.secondary_stress = self.compile_stress(self._stress_expressions[1])
 
-    def stressify(self, ps: Phonemes):
-        syllables = self.syllables(ps)
+    @staticmethod
+    def compile_stress(expression):
+        """Turns a stress expression in terms of i (syllable index) and l (syllable count) into a function of i, l"""
+        if callable(expression):
+            return expression
+
+        return eval(compile("lambda i, l: ({})".format(expression), "<stress>", "eval"))
+
+    def stress_pattern(self, syllable_count):
+        """Stress of every syllable in a word with syllable_count syllables, only worked out once per count"""
+        pattern = self._stress_patterns.get(syllable_count)
+
+        if pattern is None:
+            pattern = []
 
-        syllable_count = len(syllables)
+            for i in range(0, syllable_count):
+                stress = Stress.unstressed
 
-        for i in range(0, syllable_count):
-            syllable = syllables[i]
-            stress = Stress.unstressed
+                if self.primary_stress(i, syllable_count):
+                    stress = Stress.stressed
+                elif self.secondary_stress(i, syllable_count):
+                    stress = Stress.secondary_stressed
 
-            if self.primary_stress(i, syllable_count):
-                stress = Stress.stressed
-            elif self.secondary_stress(i, syllable_count):
-                stress = Stress.secondary_stressed
+                pattern.append(stress)
 
-            for phoneme in syllable:
-                phoneme.stress = stress
+            pattern = tuple(pattern)
+            self._stress_patterns[syllable_count] = pattern
+
+        return pattern
+
+    def stressify(self, ps: Phonemes):
+        syllables = self.syllable_ranges(ps)
+
+        for syllable, stress in zip(syllables, self.stress_pattern(len(syllables))):
+            ps.set_stress(syllable.start, syllable.stop, stress)
 
     def syllables(self, phonemes: Phonemes) -> List[Phonemes]:
-        """
-        syllables = []
+        return [phonemes[r.start:r.stop] for r in self.syllable_ranges(phonemes)]
 
-        i = 0
-        l = len(ps)
-        while i < l:
-            syllable = []
-
-            for j in range(0, self.required_onsets + self.optional_onsets):
-                if ps[i].has_prop("consonant"):
-                    syllable.append(ps[i])
-                    i += 1
-                elif j < self.required_onsets:
-                    raise Exception("{} has invalid syllable structure".format(ps))
-                else:
-                    break
+    def _syllable_ends(self, runs, k):
+        """Indices where a syllable starting at k can end, shortest coda first"""
+        n = len(runs) - 1
+        onsets = runs[k]
+        vowel = k + onsets
 
-            if ps[i].has_prop("vowel"):
-                syllable.append(ps[i])
-                i += 1
-            else:
-                raise Exception("{} has invalid syllable structure".format(ps))
-
-            for j in range(0, self.required_codas + self.optional_codas):
-                if i < l and ps[i].has_prop("consonant"):
-                    syllable.append(ps[i])
-                    i += 1
-                elif j < self.required_codas:
-                    raise Exception("{} has invalid syllable structure".format(ps))
-                else:
-                    break
+        if onsets < self.min_onsets or onsets > self.max_onsets or vowel >= n:
+            return range(0)  # Onsets are always as long as possible, the next phoneme has to be a vowel
 
-            syllables.append(Phonemes(syllable))
+        codas = min(self.max_codas, runs[vowel + 1])
+        return range(vowel + 1 + self.min_codas, vowel + 2 + codas)
 
-        return syllables
+    def syllable_ranges(self, phonemes: Phonemes) -> List[range]:
         """
-        ps = phonemes.phonemes
-        cv_pattern = "".join(map(lambda p: "v" if p.has_prop("vowel") else "c", ps))
-        full_cv_pattern = cv_pattern
+        Splits the phonemes into syllables with the longest possible onsets and shortest possible codas.
+        Runs in linear time, first working out which suffixes can be split at all, then picking syllables left to right
+        """
+        codes = phonemes.codes
+        n = len(codes)
+
+        # runs[k] is the number of consonants starting at k
+        runs = [0] * (n + 1)
+        for k in range(n - 1, -1, -1):
+            runs[k] = 0 if codes[k] < VOWEL_COUNT else runs[k + 1] + 1
+
+        # valid[k] is True if phonemes[k:] can be broken into syllables
+        valid = [False] * (n + 1)
+        valid[n] = True
+        for k in range(n - 1, -1, -1):
+            valid[k] = any(valid[end] for end in self._syllable_ends(runs, k))
+
+        if not valid[0]:
+            raise Exception("{} could not be broken into syllables, invalid syllable at phoneme {}".format(
+                phonemes, self._error_position(runs)))
 
         syllables = []
+        k = 0
+        while k < n:
+            end = next(end for end in self._syllable_ends(runs, k) if valid[end])
+            syllables.append(range(k, end))
+            k = end
 
-        while len(cv_pattern) > 0:
-            # Because of regex limitations, we can only extract the last syllable's length
-            # This is a bit of a hack, but the alternative is incredibly complex string parsing code
-            result = self.syllable_regex.match(cv_pattern)
+        return syllables
 
-            if not result:
-                raise Exception("{} could not be broken into syllables ({})".format(Phonemes(ps), full_cv_pattern))
+    def _error_position(self, runs):
+        # Furthest point a valid sequence of syllables can reach from the start of the word
+        n = len(runs) - 1
+        reachable = [False] * (n + 1)
+        reachable[0] = True
+        furthest = 0
 
-            syllable_len = len(result.group(1))
+        for k in range(0, n):
+            if reachable[k]:
+                furthest = k
+                for end in self._syllable_ends(runs, k):
+                    reachable[end] = True
 
-            syllables.insert(0, ps[-syllable_len:])
+        return furthest
 
-            cv_pattern = cv_pattern[:-syllable_len]  # string slicing is O(n^2), optimize if needed
-            ps = ps[:-syllable_len]
 
-        return syllables
+def derive(raw: Phonemes, syllable_data: SyllableData, rules: RuleSet, trace: RuleTrace=None) -> Phonemes:
+    ps = raw.copy()
+    syllable_data.stressify(ps)  # Solve stressing for rules
+    rules.apply(ps, trace)       # Apply phonetic rules
+    syllable_data.stressify(ps)  # Reapply stressing, since syllables may have moved / changed
+    return ps
+
+
+# Set in each worker process of Language.derive_all
+_worker_language = None
+
+
+def _start_worker(syllable_data, rules, morphemes):
+    global _worker_language
+    _worker_language = syllable_data, rules, morphemes
+
+
+def _derive_chunk(chunk):
+    syllable_data, rules, morphemes = _worker_language
+    results = []
+
+    for morpheme_indices in chunk:
+        raw = Phonemes()
+        for i in morpheme_indices:
+            raw = morphemes[i].apply(raw)
+
+        trace = RuleTrace()
+
+        try:
+            codes = derive(raw, syllable_data, rules, trace).codes
+        except Exception as e:
+            results.append((None, None, e))
+            continue
+
+        results.append((codes, (trace.fired, trace.codes), None))
+
+    return results
 
 
 class Language:
-    def __init__(self, path):
+    # Source files in the order they depend on each other
+    FILES = {
+        "romanization": "romanization.txt",
+        "attributes": "attributes.txt",
+        "rules": "rules.txt",
+        "dictionary": "proto_dictionary.txt"
+    }
+
+    SNAPSHOT = "language.snapshot"
+
+    def __init__(self, path, workers=1, use_snapshot=True):
+        """
+        Loads the language in the directory at path. If it has a snapshot from compile that is newer than the
+        sources, that is loaded instead
+        """
         path = path.rstrip("/")
 
-        self.romanization = self._load_romanization(path + "/romanization.txt")
-        self.syllable_data = self._load_attributes(path + "/attributes.txt")
-        self.rules = self._load_rules(path + "/rules.txt")
-        self.dictionary = self._load_dictionary(path + "/proto_dictionary.txt")
+        self.path = path
+        self.workers = workers
+        self._version = 0
+
+        snapshot_path = path + "/" + self.SNAPSHOT
+        if use_snapshot and snapshot.is_fresh(path, snapshot_path, self.FILES.values()):
+            self.dictionary = Dictionary(self)
+            if snapshot.read(self, snapshot_path):
+                return
+
+        self.romanization = self._load_romanization(self.file_path("romanization"))
+        self.syllable_data = self._load_attributes(self.file_path("attributes"))
+        self.rules = self._load_rules(self.file_path("rules"))
+        self.dictionary = self._load_dictionary(self.file_path("dictionary"))
+
+    @staticmethod
+    def compile(path, workers=1):
+        """
+        Loads the language at path from its sources, and writes a snapshot of it next to them that later loads
+        will use until the sources change. Returns the language
+        """
+        lang = Language(path, workers, use_snapshot=False)
+        lang.derive_all(workers)
+        snapshot.write(lang, lang.path + "/" + Language.SNAPSHOT)
+        return lang
+
+    def file_path(self, name):
+        return self.path + "/" + self.FILES[name]
+
+    def reload(self, name):
+        """
+        Reads one of the source files again (a key of FILES) and switches to it once it has been parsed, only deriving
+        the words again that it could affect. Returns the same as update_rules
+        """
+        path = self.file_path(name)
+
+        if name == "romanization":
+            return self.update_romanization(self._load_romanization(path))
+        if name == "attributes":
+            return self.update_syllable_data(self._load_attributes(path))
+        if name == "rules":
+            return self.update_rules(self._load_rules(path))
+        if name == "dictionary":
+            entries = self._parse_dictionary(path)
+            return self.dictionary.rederive(lambda: self.dictionary.reload(entries), lambda word: not word.is_derived())
+
+        raise Exception("Unknown language file '{}'".format(name))
+
+    @property
+    def version(self):
+        # Derived forms are only valid for the version they were made with, see Word.derivation
+        return self._version, self.rules.version
+
+    @property
+    def romanization(self) -> Romanization:
+        return self._romanization
+
+    @romanization.setter
+    def romanization(self, romanization: Romanization):
+        self._romanization = romanization
+        self._version += 1
+
+    @property
+    def syllable_data(self) -> SyllableData:
+        return self._syllable_data
+
+    @syllable_data.setter
+    def syllable_data(self, syllable_data: SyllableData):
+        self._syllable_data = syllable_data
+        self._version += 1
+
+    @property
+    def rules(self) -> RuleSet:
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules: RuleSet):
+        self._rules = rules
+        self._version += 1
+
+    def derive(self, raw: Phonemes, trace: RuleTrace=None) -> Phonemes:
+        return derive(raw, self.syllable_data, self.rules, trace)
+
+    def update_rules(self, rules: RuleSet):
+        """
+        Switches to a new set of rules, only deriving the words again that a removed or added rule could change.
+        Returns (word, old phonemes, new phonemes) for every word whose pronunciation changed
+        """
+        old_rules = self.rules.rules
+        removed, added = self.rules.diff(rules)
+
+        # Where each of the current rules is in the new set, None if it was removed
+        new_indices = {rule: i for i, rule in enumerate(rules.rules)}
+        moved = [new_indices.get(rule) for rule in old_rules]
+
+        def affected(word):
+            trace = word.trace
+            if trace is None:
+                return True
+
+            fired = tuple(moved[i] for i in trace.fired)
+            if None in fired or any(rule.could_match(trace.codes) for rule in added):
+                return True
+
+            trace.fired = fired  # The word is kept, so its trace has to point into the new rules
+            return False
+
+        def change():
+            self.rules = rules
+
+        return self.dictionary.rederive(change, affected)
+
+    def update_syllable_data(self, syllable_data: SyllableData):
+        """Switches to new syllable data, every word has to be derived again. Returns the same as update_rules"""
+        def change():
+            self.syllable_data = syllable_data
+
+        return self.dictionary.rederive(change)
+
+    def update_romanization(self, romanization: Romanization):
+        """
+        Switches to a new romanization, only deriving words again if they use a morpheme with a changed letter.
+        Returns the same as update_rules
+        """
+        old = self.romanization.mapping
+        new = romanization.mapping
+        letters = {letter for letter in set(old) | set(new) if old.get(letter) is not new.get(letter)}
+        morphemes = {tag: morpheme for tag, morpheme in self.dictionary.morphemes.items()
+                     if morpheme.text is not None and not letters.isdisjoint(morpheme.text)}
+        changed = set(morphemes.values())
+
+        for morpheme in changed:
+            romanization.roman_to_phonemes(morpheme.text.replace("-", ""))  # Fail before anything is changed
+
+        def change():
+            self.romanization = romanization
+            for tag, morpheme in morphemes.items():
+                self.dictionary.add_morpheme(tag, morpheme.text, morpheme.definitions)
+
+        return self.dictionary.rederive(change, lambda word: not changed.isdisjoint(word.morphemes))
+
+    def update_morpheme(self, tag, text, definitions):
+        """Adds or redefines a morpheme, only deriving the words using it again. Returns the same as update_rules"""
+        morpheme = self.dictionary.morphemes.get(tag)
+
+        def change():
+            self.dictionary.add_morpheme(tag, text, definitions)
+
+        return self.dictionary.rederive(change, lambda word: morpheme in word.morphemes)
+
+    def derive_all(self, workers=None, words=None, chunk_size=500):
+        """
+        Derives every word in the dictionary (or just words) that isn't already derived, spread over worker processes.
+        workers defaults to one per core, with 1 everything runs in this process.
+        Returns (word, phonemes, error) for every word, and caches the results on the words
+        """
+        words = self.dictionary.words if words is None else words
+        workers = os.cpu_count() if workers is None else workers
+        pending = [word for word in words if not word.is_derived()]
+
+        if workers > 1 and len(pending) > chunk_size:
+            morphemes = []
+            morpheme_indices = {}
+            chunks = []
+
+            for start in range(0, len(pending), chunk_size):
+                chunk = []
+                for word in pending[start:start + chunk_size]:
+                    for morpheme in word.morphemes:
+                        if id(morpheme) not in morpheme_indices:
+                            morpheme_indices[id(morpheme)] = len(morphemes)
+                            morphemes.append(morpheme)
+
+                    chunk.append([morpheme_indices[id(morpheme)] for morpheme in word.morphemes])
+                chunks.append(chunk)
+
+            from concurrent.futures import ProcessPoolExecutor  # Slow to import, and most uses never need it
+
+            # The language is sent once per worker, then only morpheme indices and phoneme codes go back and forth
+            with ProcessPoolExecutor(workers, initializer=_start_worker,
+                                     initargs=(self.syllable_data, self.rules, morphemes)) as executor:
+                words_results = zip(pending, (r for results in executor.map(_derive_chunk, chunks) for r in results))
+
+                for word, (codes, traced, error) in words_results:
+                    if error is None:
+                        word.set_derivation(Phonemes.from_codes(codes), RuleTrace(*traced))
+                    else:
+                        word.set_error(error)
+
+        results = []
+        for word in words:
+            try:
+                results.append((word, word.phonemes, None))
+            except Exception as e:
+                results.append((word, None, e))
+
+        return results
+
+    def profile_rules(self, words=None) -> RuleProfile:
+        """
+        Applies the rules again to every word in the dictionary (or just words) in this process, counting and timing
+        each rule. The words keep what they have cached. Returns the RuleProfile, see RuleProfile.report and to_json
+        """
+        words = self.dictionary.words if words is None else words
+        profile = self.rules.enable_profiling()
+
+        try:
+            for word in words:
+                try:
+                    # The words' cached derivations are never used or filled in
+                    self.derive(word.build_raw_phonemes())
+                except Exception:
+                    pass  # Rules that ran before a word failed are still counted
+        finally:
+            self.rules.disable_profiling()
+
+        return profile
 
     def to_phonemes(self, text):
         return self.romanization.roman_to_phonemes(text)
@@ -168,6 +471,12 @@ class Language:
 
     def _load_dictionary(self, path):
         dictionary = Dictionary(self)
+        dictionary.load(self._parse_dictionary(path), self.workers)
+        return dictionary
+
+    @staticmethod
+    def _parse_dictionary(path):
+        entries = []
 
         with open(path, encoding="utf-8") as f:
             for line in f:
@@ -181,15 +490,14 @@ class Language:
 
                 if len(cells) == 2:
                     tags = text.split("+")
-                    word = dictionary.to_word(tags, definitions)
-                    dictionary.add_word(word)
+                    entries.append((tags, definitions))
                 elif len(cells) == 3:
                     tag = cells[1]
-                    dictionary.add_morpheme(tag, text, definitions)
+                    entries.append((tag, text, definitions))
                 else:
                     raise Exception("Bad line '{}'".format(cells))
 
-        return dictionary
+        return entries
 
     def _load_rules(self, path):
         rules = []
@@ -222,10 +530,8 @@ class Language:
                         "req_codas": coda.count("c") - coda.count("(")
                     })
                 elif k == "primary_stress":
-                    code = compile(v, "<string>", "eval")
-                    syllable_data["prime_stress"] = lambda i, l: eval(code)
+                    syllable_data["prime_stress"] = v
                 elif k == "secondary_stress":
-                    code2 = compile(v, "<string>", "eval")
-                    syllable_data["second_stress"] = lambda i, l: eval(code2)
+                    syllable_data["second_stress"] = v
 
         return SyllableData(**syllable_data)
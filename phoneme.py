@@ -1,7 +1,11 @@
 import csv
+import importlib.util
+import os
+import sys
 from abc import ABC, abstractmethod
+from array import array
 from enum import Enum
-from typing import List
+from typing import Iterable, List
 
 
 class POA(Enum):
@@ -70,26 +74,132 @@ class Stress(Enum):
     stressed = 2
 
 
+def _build_features():
+    features = {}
+
+    for enum in [Length, Stress, Height, Frontness, Rounding, POA, MOA, Voicing]:
+        for member in enum:
+            features[member.name] = 1 << len(features)
+
+    for key in ["vowel", "consonant", "obstruent", "sibilant", "sonorant", "vibrant", "lateral", "occlusive"]:
+        features[key] = 1 << len(features)
+
+    return features
+
+
+# Every property usable in a rule gets one bit, so a phoneme's properties can be tested with a single AND
+FEATURES = _build_features()
+
+_MANNER_CLASSES = {
+    "obstruent": {MOA.plosive, MOA.fricative, MOA.affricate},
+    "sonorant": {MOA.approximate, MOA.nasal, MOA.tap, MOA.trill},
+    "vibrant": {MOA.tap, MOA.trill},
+    "lateral": {MOA.lateral_approximant, MOA.lateral_fricative},
+    "occlusive": {MOA.plosive, MOA.nasal, MOA.affricate, MOA.implosive, MOA.ejective, MOA.click}
+}
+
+_MANNER_FEATURES = {manner: FEATURES[manner.name] for manner in MOA}
+for _key, _manners in _MANNER_CLASSES.items():
+    for _manner in _manners:
+        _MANNER_FEATURES[_manner] |= FEATURES[_key]
+
+_SIBILANT_PLACES = {POA.alveolar, POA.postalveolar, POA.retroflex}
+
+
+def feature_mask(key):
+    """Bit mask for a property key, unknown keys get an empty mask and never match"""
+    return FEATURES.get(key, 0)
+
+
+# Every combination of features, length and stress has a fixed code, vowels first and then consonants.
+# Stress is the lowest digit of a code, so restressing a phoneme is a single addition. Vowel codes are below VOWEL_COUNT
+STRESS_COUNT = len(Stress)
+VOWEL_COUNT = len(Height) * len(Frontness) * len(Rounding) * len(Length) * len(Stress)
+_CONSONANT_COUNT = len(MOA) * len(POA) * len(Voicing) * len(Length) * len(Stress)
+PHONEME_COUNT = VOWEL_COUNT + _CONSONANT_COUNT
+
+# Codes with stress removed, and length for consonants, so codes that are == share a key code
+_KEY_CODES = [code - code % STRESS_COUNT if code < VOWEL_COUNT else
+              code - (code - VOWEL_COUNT) % (STRESS_COUNT * len(Length)) for code in range(0, PHONEME_COUNT)]
+
+# Interned phonemes by code, created the first time they are used
+_interned = [None] * PHONEME_COUNT
+
+
+def phoneme_from_code(code):
+    phoneme = _interned[code]
+    if phoneme is not None:
+        return phoneme
+
+    if code < VOWEL_COUNT:
+        rest, stress = divmod(code, len(Stress))
+        rest, length = divmod(rest, len(Length))
+        rest, rounding = divmod(rest, len(Rounding))
+        height, frontness = divmod(rest, len(Frontness))
+        return Vowel(length, stress, height, frontness, rounding)
+
+    rest, stress = divmod(code - VOWEL_COUNT, len(Stress))
+    rest, length = divmod(rest, len(Length))
+    rest, voicing = divmod(rest, len(Voicing))
+    manner, place = divmod(rest, len(POA))
+    return Consonant(length, stress, manner, place, voicing)
+
+
+def all_phonemes() -> List["Phoneme"]:
+    return [phoneme_from_code(code) for code in range(0, PHONEME_COUNT)]
+
+
 class Phoneme(ABC):
-    def __init__(self, length, stress):
-        self.length = enum_clean(Length, length)
-        self.stress = enum_clean(Stress, stress)
+    """
+    Phonemes are immutable and interned, there is only ever one instance for each code.
+    Use replace() or with_stress() to get a modified phoneme.
+    """
+    __slots__ = ("length", "stress", "features", "code")
+
+    @classmethod
+    def _intern(cls, code, attrs):
+        phoneme = object.__new__(cls)
+
+        for key, value in attrs.items():
+            object.__setattr__(phoneme, key, value)
+
+        object.__setattr__(phoneme, "code", code)
+        object.__setattr__(phoneme, "features", phoneme._features())
+        _interned[code] = phoneme
+
+        return phoneme
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Phonemes are immutable, use replace() to change {}".format(key))
+
+    def __delattr__(self, key):
+        raise AttributeError("Phonemes are immutable, cannot delete {}".format(key))
+
+    def __reduce__(self):
+        return phoneme_from_code, (self.code,)
+
+    def _features(self):
+        return FEATURES[self.length.name] | FEATURES[self.stress.name]
 
     @abstractmethod
     def as_dict(self):
         pass
 
+    def replace(self, **changes):
+        props = self.as_dict()
+        props.update(changes)
+        return type(self)(**props)
+
+    def with_stress(self, stress):
+        stress = enum_clean(Stress, stress)
+        return phoneme_from_code(self.code + stress.value - self.stress.value)
+
     @property
     def props(self):
         return Ipa.phoneme_to_ipa(self)
 
     def has_prop(self, key):
-        if key == self.stress.name:
-            return True
-        if key == self.length.name:
-            return True
-
-        return False
+        return self.features & feature_mask(key) != 0
 
     @property
     def ipa(self):
@@ -106,55 +216,111 @@ class Phoneme(ABC):
         attrs = ", ".join(map(lambda e: e.name, self.as_dict().values()))
         return "{}<{}>".format(self.ipa, attrs)
 
-    @abstractmethod
     def copy(self):
-        pass
+        return self
+
+
+# Codes are all below the surrogate range, so their native UTF-16 bytes decode to one character per code
+_CODE_TEXT_ENCODING = "utf-16-le" if sys.byteorder == "little" else "utf-16-be"
 
 
 class Phonemes:
-    def __init__(self, phonemes: List[Phoneme]=None):
-        if phonemes is not None:
-            self.phonemes = phonemes
-        else:
-            self.phonemes = []
+    """
+    A sequence of phonemes, stored compactly as an array of phoneme codes.
+    Slices are zero-copy views that share storage with the original until either of them is written to, the one written
+    to gets its own copy first, so neither ever sees changes made to the other.
+    """
+    __slots__ = ("_codes", "_shared")
+
+    def __init__(self, phonemes: Iterable[Phoneme]=None):
+        self._codes = array("H", [] if phonemes is None else [p.code for p in phonemes])
+        self._shared = False  # Views were taken of _codes, it has to be copied before it is changed
+
+    @staticmethod
+    def from_codes(codes) -> "Phonemes":
+        """Wrap an array or memoryview of phoneme codes without copying it"""
+        ps = Phonemes.__new__(Phonemes)
+        ps._codes = codes
+        ps._shared = False
+        return ps
+
+    @property
+    def codes(self):
+        return self._codes
+
+    @property
+    def code_text(self) -> str:
+        """The codes as a string with one character per phoneme, chr(code), for matching with regular expressions"""
+        return self._codes.tobytes().decode(_CODE_TEXT_ENCODING)
+
+    @property
+    def phonemes(self) -> List[Phoneme]:
+        return list(self)
+
+    def _array(self) -> array:
+        if isinstance(self._codes, array):
+            return self._codes
+
+        codes = array("H")
+        codes.frombytes(self._codes.tobytes())
+        return codes
+
+    def _own(self):
+        # Views are read only until written to, then they get their own storage, as does storage views were taken of
+        if not isinstance(self._codes, array):
+            self._codes = self._array()
+        elif self._shared:
+            self._codes = self._codes[:]
+            self._shared = False
 
     @property
     def ipa(self):
         return Ipa.phonemes_to_ipa(self)
 
     def __repr__(self):
-        items = ", ".join(map(repr, self.phonemes))
+        items = ", ".join(map(repr, self))
         return "[{}]".format(items)
 
     def __str__(self):
         return self.ipa
 
+    def __reduce__(self):
+        return Phonemes.from_codes, (self._array(),)
+
     def __add__(self, other):
-        a = self.phonemes.copy()
-        b = other.phonemes.copy()
-        a.extend(b)
-        return Phonemes(a)
+        a = self._codes if isinstance(self._codes, array) else self._array()
+        b = other._codes if isinstance(other._codes, array) else other._array()
+        return Phonemes.from_codes(a + b)
 
     def __bool__(self):
-        return len(self.phonemes) > 0
+        return len(self._codes) > 0
 
     def __contains__(self, item):
-        for phoneme in self.phonemes:
+        for phoneme in self:
             if phoneme == item:
                 return True
 
         return False
 
     def copy(self):
-        return Phonemes([p.copy() for p in self.phonemes])
+        return Phonemes.from_codes(self._codes[:] if isinstance(self._codes, array) else self._array())
 
     def __delitem__(self, key):
-        del self.phonemes[key]
+        self._own()
+
+        try:
+            del self._codes[key]
+        except BufferError:  # Views are still using the buffer, leave it to them
+            self._codes = self._codes[:]
+            del self._codes[key]
 
     def __eq__(self, other):
         if len(self) != len(other):
             return False
 
+        if isinstance(other, Phonemes) and self._codes == other._codes:
+            return True
+
         for i in range(0, len(self)):
             if self[i] != other[i]:
                 return False
@@ -165,19 +331,60 @@ class Phonemes:
         return not self.__eq__(other)
 
     def __getitem__(self, item):
-        return self.phonemes[item]
+        if isinstance(item, slice):
+            if isinstance(self._codes, memoryview):
+                codes = self._codes
+            else:
+                codes = memoryview(self._codes)
+                self._shared = True
+            return Phonemes.from_codes(codes[item])
+
+        return phoneme_from_code(self._codes[item])
+
+    def key(self) -> tuple:
+        """Hashable key, equal for any Phonemes that are =="""
+        return tuple(map(_KEY_CODES.__getitem__, self._codes))
+
+    def sort_key(self) -> tuple:
+        """Key that sorts the same way as <, by the IPA of each phoneme and then length"""
+        key = tuple(p.ipa for p in self)
+
+        if not all(key):
+            raise Exception("Unknown ipa in {}".format(repr(self)))
+
+        return key
 
     def __hash__(self):
-        return hash(self.ipa)
+        return hash(self.key())
 
     def __iter__(self):
-        return iter(self.phonemes)
+        return map(phoneme_from_code, self._codes)
 
     def __len__(self):
-        return len(self.phonemes)
+        return len(self._codes)
+
+    def set_stress(self, start, stop, stress):
+        """Restress phonemes start to stop in place"""
+        self._own()
+        codes = self._codes
+        stress = enum_clean(Stress, stress).value
+
+        for i in range(start, stop):
+            code = codes[i]
+            codes[i] = code - code % STRESS_COUNT + stress  # Stress is the lowest digit of the code
 
     def __setitem__(self, key, value):
-        self.phonemes[key] = value
+        self._own()
+
+        if isinstance(key, slice):
+            codes = array("H", [p.code for p in value])
+            try:
+                self._codes[key] = codes
+            except BufferError:  # Resized while something else is using the buffer, same as __delitem__
+                self._codes = self._codes[:]
+                self._codes[key] = codes
+        else:
+            self._codes[key] = value.code
 
     def __lt__(self, other):
         return self._compare(other) < 0
@@ -193,7 +400,7 @@ class Phonemes:
 
     def _compare(self, other):
         if isinstance(other, Phonemes):
-            for p1, p2 in zip(self.phonemes, other.phonemes):
+            for p1, p2 in zip(self, other):
                 ipa1 = p1.ipa
                 ipa2 = p2.ipa
 
@@ -205,8 +412,8 @@ class Phonemes:
                 elif ipa1 > ipa2:
                     return 1
 
-            l1 = len(self.phonemes)
-            l2 = len(other.phonemes)
+            l1 = len(self)
+            l2 = len(other)
 
             if l1 < l2:
                 return -1
@@ -235,27 +442,36 @@ def enum_clean(enum, value):
 
 
 class Vowel(Phoneme):
-    def __init__(self, length, stress, height, frontness, rounding):
-        super().__init__(length, stress)
-        self.height = enum_clean(Height, height)
-        self.frontness = enum_clean(Frontness, frontness)
-        self.rounding = enum_clean(Rounding, rounding)
-
-    def has_prop(self, key):
-        if super().has_prop(key):
-            return True
-        if key == "vowel":
-            return True
-        if key == "consonant":
-            return False
-        if key == self.height.name:
-            return True
-        if key == self.frontness.name:
-            return True
-        if key == self.rounding.name:
-            return True
-
-        return False
+    __slots__ = ("height", "frontness", "rounding")
+
+    def __new__(cls, length, stress, height, frontness, rounding):
+        length = enum_clean(Length, length)
+        stress = enum_clean(Stress, stress)
+        height = enum_clean(Height, height)
+        frontness = enum_clean(Frontness, frontness)
+        rounding = enum_clean(Rounding, rounding)
+
+        code = height.value
+        code = code * len(Frontness) + frontness.value
+        code = code * len(Rounding) + rounding.value
+        code = code * len(Length) + length.value
+        code = code * len(Stress) + stress.value
+
+        phoneme = _interned[code]
+        if phoneme is not None:
+            return phoneme
+
+        return cls._intern(code, {
+            "length": length,
+            "stress": stress,
+            "height": height,
+            "frontness": frontness,
+            "rounding": rounding
+        })
+
+    def _features(self):
+        return super()._features() | FEATURES["vowel"] | FEATURES[self.height.name] | \
+               FEATURES[self.frontness.name] | FEATURES[self.rounding.name]
 
     def as_dict(self):
         return {
@@ -273,44 +489,47 @@ class Vowel(Phoneme):
                    self.rounding == other.rounding and \
                    self.length == other.length
 
-    def copy(self):
-        return Vowel(**self.as_dict())
+    def __hash__(self):
+        return hash(self.code // len(Stress))  # Stress is ignored by __eq__
 
 
 class Consonant(Phoneme):
-    def __init__(self, length, stress, manner, place, voicing):
-        super().__init__(length, stress)
-        self.place = enum_clean(POA, place)
-        self.manner = enum_clean(MOA, manner)
-        self.voicing = enum_clean(Voicing, voicing)
-
-    def has_prop(self, key):
-        if super().has_prop(key):
-            return True
-        if key == "vowel":
-            return False
-        if key == "consonant":
-            return True
-        if key == self.place.name:
-            return True
-        if key == self.manner.name:
-            return True
-        if key == self.voicing.name:
-            return True
-        if key == "obstruent":
-            return self.manner in {MOA.plosive, MOA.fricative, MOA.affricate}
-        if key == "sibilant":
-            return self.manner == MOA.fricative and self.place in {POA.alveolar, POA.postalveolar, POA.retroflex}
-        if key == "sonorant":
-            return self.manner in {MOA.approximate, MOA.nasal, MOA.tap, MOA.trill}
-        if key == "vibrant":
-            return self.manner in {MOA.tap, MOA.trill}
-        if key == "lateral":
-            return self.manner in {MOA.lateral_approximant, MOA.lateral_fricative}
-        if key == "occlusive":
-            return self.manner in {MOA.plosive, MOA.nasal, MOA.affricate, MOA.implosive, MOA.ejective, MOA.click}
-
-        return False
+    __slots__ = ("manner", "place", "voicing")
+
+    def __new__(cls, length, stress, manner, place, voicing):
+        length = enum_clean(Length, length)
+        stress = enum_clean(Stress, stress)
+        manner = enum_clean(MOA, manner)
+        place = enum_clean(POA, place)
+        voicing = enum_clean(Voicing, voicing)
+
+        code = manner.value
+        code = code * len(POA) + place.value
+        code = code * len(Voicing) + voicing.value
+        code = code * len(Length) + length.value
+        code = code * len(Stress) + stress.value
+        code += VOWEL_COUNT
+
+        phoneme = _interned[code]
+        if phoneme is not None:
+            return phoneme
+
+        return cls._intern(code, {
+            "length": length,
+            "stress": stress,
+            "manner": manner,
+            "place": place,
+            "voicing": voicing
+        })
+
+    def _features(self):
+        features = super()._features() | FEATURES["consonant"] | _MANNER_FEATURES[self.manner] | \
+                   FEATURES[self.place.name] | FEATURES[self.voicing.name]
+
+        if self.manner == MOA.fricative and self.place in _SIBILANT_PLACES:
+            features |= FEATURES["sibilant"]
+
+        return features
 
     def as_dict(self):
         return {
@@ -327,24 +546,77 @@ class Consonant(Phoneme):
                    self.manner == other.manner and \
                    self.voicing == other.voicing
 
-    def copy(self):
-        return Consonant(**self.as_dict())
+    def __hash__(self):
+        return hash((self.code - VOWEL_COUNT) // (len(Stress) * len(Length)))  # Length and stress are ignored by __eq__
 
 
 class IPA:
-    def __init__(self):
-        self._vowel_data = {}
-        self._consonant_data = {}
-        self._ipa_phoneme_data = {}
-        self._load_vowels()
-        self._load_consonants()
-        print()
-
-    def _load_vowels(self):
-        rows = list(csv.reader(open('vowels.txt', 'r', encoding="utf-8"), delimiter='\t'))
+    """
+    Converts phonemes to and from IPA with the tables in vowels.txt and consonants.txt, which are read the first time
+    they are needed. If write_table has made ipa_table.py from the current files, that is used instead
+    """
+    FILES = ["vowels.txt", "consonants.txt"]
+    TABLE = "ipa_table.py"
+
+    def __init__(self, path=None):
+        self.path = os.path.dirname(os.path.abspath(__file__)) if path is None else path
+        self._vowel_data = None
+        self._consonant_data = None
+        self._ipa_phoneme_data = None
+
+    def _load(self):
+        rows = self._read_table()
+        if rows is None:
+            rows = [self._read_rows(file) for file in self.FILES]
+
+        # Everything is set at the end, so other threads never see half loaded tables
+        ipa_phoneme_data = {}
+        vowel_data = self._load_vowels(rows[0], ipa_phoneme_data)
+        consonant_data = self._load_consonants(rows[1], ipa_phoneme_data)
+        self._ipa_phoneme_data = ipa_phoneme_data
+        self._consonant_data = consonant_data
+        self._vowel_data = vowel_data
+
+    def _read_rows(self, file):
+        with open(os.path.join(self.path, file), encoding="utf-8") as f:
+            return list(csv.reader(f, delimiter='\t'))
+
+    def _file_stats(self):
+        stats = []
+        for file in self.FILES:
+            stat = os.stat(os.path.join(self.path, file))
+            stats.append((stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    def _read_table(self):
+        table_path = os.path.join(self.path, self.TABLE)
+        if not os.path.exists(table_path):
+            return None
+
+        spec = importlib.util.spec_from_file_location("ipa_table", table_path)
+        table = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(table)
+
+        if table.STATS != self._file_stats():
+            return None  # The text files were changed after the table was made
+
+        return table.ROWS
+
+    def write_table(self):
+        """Saves the parsed tables as python in ipa_table.py, which loads faster than the text files"""
+        rows = [self._read_rows(file) for file in self.FILES]
+
+        with open(os.path.join(self.path, self.TABLE), "w", encoding="utf-8") as f:
+            f.write("# Made by IPA.write_table from {}, don't edit\n".format(" and ".join(self.FILES)))
+            f.write("STATS = {!r}\n".format(self._file_stats()))
+            f.write("ROWS = {!r}\n".format(rows))
+
+    @staticmethod
+    def _load_vowels(rows, ipa_phoneme_data):
+        vowel_data = {}
         for y in range(1, 8):
             height = Height(y - 1)
-            self._vowel_data[height] = {}
+            vowel_data[height] = {}
 
             for x in range(1, 7):
                 char = rows[y][x]
@@ -352,28 +624,33 @@ class IPA:
                 frontness = Frontness((x - 1) // 2)
                 rounding = Rounding((x - 1) % 2)
 
-                if frontness not in self._vowel_data[height]:
-                    self._vowel_data[height][frontness] = {}
+                if frontness not in vowel_data[height]:
+                    vowel_data[height][frontness] = {}
+
+                vowel_data[height][frontness][rounding] = char
+                ipa_phoneme_data[char] = (Vowel, height, frontness, rounding)
 
-                self._vowel_data[height][frontness][rounding] = char
-                self._ipa_phoneme_data[char] = (Vowel, height, frontness, rounding)
+        return vowel_data
 
-    def _load_consonants(self):
-        rows = list(csv.reader(open('consonants.txt', 'r', encoding="utf-8"), delimiter='\t'))
+    @staticmethod
+    def _load_consonants(rows, ipa_phoneme_data):
+        consonant_data = {}
         for y in range(1, 13):
             manner = MOA(y - 1)
-            self._consonant_data[manner] = {}
+            consonant_data[manner] = {}
             for x in range(1, 22):
                 char = rows[y][x]
 
                 place = POA((x - 1) // 2)
                 voicing = Voicing((x - 1) % 2)
 
-                if place not in self._consonant_data[manner]:
-                    self._consonant_data[manner][place] = {}
+                if place not in consonant_data[manner]:
+                    consonant_data[manner][place] = {}
 
-                self._consonant_data[manner][place][voicing] = char
-                self._ipa_phoneme_data[char] = (Consonant, manner, place, voicing)
+                consonant_data[manner][place][voicing] = char
+                ipa_phoneme_data[char] = (Consonant, manner, place, voicing)
+
+        return consonant_data
 
     @staticmethod
     def diacritic_filter(text, chars):
@@ -391,17 +668,20 @@ class IPA:
         ipa, voiced = self.diacritic_filter(ipa, "̬")
         ipa, long = self.diacritic_filter(ipa, "ː")
 
+        if self._ipa_phoneme_data is None:
+            self._load()
+
         data = self._ipa_phoneme_data[ipa]
 
         args = [Length.normal] + [Stress.unstressed] + list(data[1:])
         phoneme = data[0](*args)
 
-        if voiceless:
-            phoneme.voicing = Voicing.unvoiced
-        if voiced:
-            phoneme.voicing = Voicing.voiced
+        if voiceless and isinstance(phoneme, Consonant):
+            phoneme = phoneme.replace(voicing=Voicing.unvoiced)
+        if voiced and isinstance(phoneme, Consonant):
+            phoneme = phoneme.replace(voicing=Voicing.voiced)
         if long:
-            phoneme.length = Length.long
+            phoneme = phoneme.replace(length=Length.long)
 
         return phoneme
 
@@ -444,11 +724,14 @@ class IPA:
         return ipa
 
     def phoneme_to_base_ipa(self, phoneme):
+        if self._vowel_data is None:
+            self._load()
+
         ipa = None
         if isinstance(phoneme, Vowel):
             ipa = self._vowel_data[phoneme.height][phoneme.frontness][phoneme.rounding]
         if isinstance(phoneme, Consonant):
-            ipa = self._consonant_data[phoneme.manner][phoneme.place][phoneme.voicing]
+            ipa = self._consonant_data[phoneme.manner][phoneme.place].get(phoneme.voicing)  # Not every cell exists
 
         return ipa
 
@@ -495,4 +778,4 @@ def auto_complete_property(prop_key):
     raise KeyError("Unknown key {}".format(prop_key))
 
 
-Ipa = IPA()
+Ipa = IPA()  # Nothing is read until it is first used
@@ -1,8 +1,33 @@
+import ast
+import difflib
+import json
 import re
 from enum import Enum
+from time import perf_counter
 from typing import List
 
-from phoneme import Consonant, Vowel, auto_complete_property, Phonemes
+from phoneme import auto_complete_property, Phonemes, feature_mask, all_phonemes, enum_clean, Height, Frontness, \
+    Rounding, POA, MOA, Voicing, Length, Stress
+
+
+_codes_by_ipa = None
+
+
+def codes_by_ipa():
+    global _codes_by_ipa
+
+    if _codes_by_ipa is None:
+        _codes_by_ipa = {}
+        for phoneme in all_phonemes():
+            _codes_by_ipa.setdefault(phoneme.ipa, set()).add(phoneme.code)
+
+    return _codes_by_ipa
+
+
+class ApplyMode(Enum):
+    first = 0     # Only the first match is changed
+    all = 1       # Every match that doesn't overlap an earlier one, left to right
+    fixpoint = 2  # Keep applying to all matches until the word stops changing
 
 
 class FilterMode(Enum):
@@ -16,6 +41,7 @@ class PropertyFilter:
         self.key = key
         self.filter_mode = filter_mode
         self.invert = invert
+        self.mask = feature_mask(key) if filter_mode == FilterMode.must_have else 0
 
     @staticmethod
     def from_string(string):
@@ -36,7 +62,7 @@ class PropertyFilter:
     def matches(self, phoneme, is_first, is_last):
 
         if self.filter_mode == FilterMode.must_have:
-            result = phoneme.has_prop(self.key)
+            result = phoneme.features & self.mask != 0
         elif self.filter_mode == FilterMode.must_be:
             result = phoneme.ipa == self.key
         elif self.filter_mode == FilterMode.at:
@@ -51,6 +77,29 @@ class PropertyFilter:
 
         return result if not self.invert else not result
 
+    def codes(self):
+        """Set of phoneme codes this filter accepts, positional filters accept every code"""
+        if self.filter_mode == FilterMode.must_have:
+            codes = {p.code for p in all_phonemes() if p.features & self.mask != 0}
+        elif self.filter_mode == FilterMode.must_be:
+            codes = set(codes_by_ipa().get(self.key, ()))
+        else:
+            return {p.code for p in all_phonemes()}
+
+        return codes if not self.invert else {p.code for p in all_phonemes()} - codes
+
+    def to_regex(self):
+        """Zero width assertion for positional filters, to go around the character class of the phoneme"""
+        if self.filter_mode != FilterMode.at:
+            return "", ""
+
+        if self.key == "start":
+            return ("(?<=[\\s\\S])" if self.invert else "\\A"), ""
+        if self.key == "end":
+            return "", ("(?=[\\s\\S])" if self.invert else "\\Z")
+
+        raise Exception(":(")
+
     def __str__(self):
         pre = "!" if self.invert else ""
         return pre + str(self.key)
@@ -63,6 +112,14 @@ class PhonemeMatch:
     def __init__(self, filters):
         self.filters = filters
 
+        self.codes = None
+        for filt in filters:
+            codes = filt.codes()
+            self.codes = codes if self.codes is None else self.codes & codes
+
+        self.codes = frozenset(self.codes)
+        self.code_bits = RuleTrace.code_bits(self.codes)
+
     @staticmethod
     def from_string(string):
         props = string.split(" ")
@@ -76,6 +133,29 @@ class PhonemeMatch:
 
         return True
 
+    def to_regex(self):
+        """Regular expression matching exactly one character of Phonemes.code_text"""
+        codes = sorted(self.codes)
+
+        if not codes:
+            return "(?!)"
+
+        ranges = []
+        start = 0
+        for i in range(1, len(codes) + 1):
+            if i == len(codes) or codes[i] != codes[i - 1] + 1:  # End of a run of consecutive codes
+                first, last = codes[start], codes[i - 1]
+                ranges.append("\\u{:04x}".format(first) if first == last else "\\u{:04x}-\\u{:04x}".format(first, last))
+                start = i
+
+        before = after = ""
+        for filt in self.filters:
+            b, a = filt.to_regex()
+            before += b
+            after += a
+
+        return "{}[{}]{}".format(before, "".join(ranges), after)
+
     def __str__(self):
         return "({})".format(" ".join(map(str, self.filters)))
 
@@ -89,6 +169,11 @@ class PhonemePattern:
     def __init__(self, pattern):
         self.pattern = pattern
 
+        # One character class per phoneme, the lookahead lets finditer report overlapping matches
+        regex = "".join(phoneme_match.to_regex() for phoneme_match in pattern)
+        self.regex = re.compile(regex)
+        self.all_regex = re.compile("(?=(?:{}))".format(regex))
+
     @staticmethod
     def from_string(string):
         pattern = []
@@ -101,26 +186,17 @@ class PhonemePattern:
         return PhonemePattern(pattern)
 
     def match(self, phonemes):
-        pattern_len = len(self.pattern)
-
-        for phonemes_index in range(0, len(phonemes) - pattern_len + 1):
-            found_match = True
+        """Index and length of the first match, or -1, -1"""
+        result = self.regex.search(phonemes.code_text)
 
-            for i in range(0, pattern_len):
-                pattern_match = self.pattern[i]
-                phoneme = phonemes[phonemes_index + i]
+        if not result:
+            return -1, -1
 
-                is_first = phonemes_index + i == 0
-                is_last = phonemes_index + i == len(phonemes) - 1
+        return result.start(), len(self.pattern)
 
-                if not pattern_match.matches(phoneme, is_first, is_last):
-                    found_match = False
-                    break
-
-            if found_match:
-                return phonemes_index, pattern_len
-
-        return -1, -1
+    def match_all(self, phonemes):
+        """Start indices of every match, including overlapping ones"""
+        return [result.start() for result in self.all_regex.finditer(phonemes.code_text)]
 
     def __str__(self):
         return "".join(map(str, self.pattern))
@@ -129,29 +205,108 @@ class PhonemePattern:
         return self.__str__()
 
 
-class MutableRulePhoneme:
-    def __init__(self, phoneme):
-        self.deleted = False
-        self.type = Vowel if isinstance(phoneme, Vowel) else Consonant
-        self.props = phoneme.as_dict()
+# Properties that rule actions can change, and the enum their values are resolved to
+ACTION_PROPERTIES = {
+    "height": Height,
+    "frontness": Frontness,
+    "rounding": Rounding,
+    "place": POA,
+    "manner": MOA,
+    "voicing": Voicing,
+    "length": Length,
+    "stress": Stress
+}
+
+
+class RemoveOperation:
+    def __init__(self, index):
+        self.index = index
+
+    def apply(self, p, changes):
+        p[self.index] = None
+
+
+class SetOperation:
+    def __init__(self, index, key, value):
+        self.index = index
+        self.key = key
+        self.value = value
+
+    def apply(self, p, changes):
+        changes.setdefault(self.index, {})[self.key] = self.value
+
+
+class RuleAction:
+    """
+    Rule actions are a ; separated list of operations on the matched phonemes, which are parsed when the rule loads.
+    p[i].rem() removes phoneme i, p[i]["prop"] = value sets a property of phoneme i
+    """
+    _remove_finder = re.compile(r"^p\[(\d+)\]\.rem\(\)$")
+    _set_finder = re.compile(r"^p\[(\d+)\]\[\s*(\"[^\"]*\"|'[^']*')\s*\]\s*=\s*(.+)$")
+
+    def __init__(self, text, operations):
+        self.text = text
+        self.operations = operations
+
+    @staticmethod
+    def from_string(string, pattern_len):
+        operations = []
+
+        for statement in string.split(";"):
+            statement = statement.strip()
+
+            if not statement:
+                continue
+
+            remove = RuleAction._remove_finder.match(statement)
+            assign = RuleAction._set_finder.match(statement)
+
+            if remove:
+                index = int(remove.group(1))
+                operation = RemoveOperation(index)
+            elif assign:
+                index = int(assign.group(1))
+                key = ast.literal_eval(assign.group(2))
+
+                if key not in ACTION_PROPERTIES:
+                    raise Exception("Unknown property '{}' in '{}'".format(key, string))
 
-    def rem(self):
-        self.deleted = True
+                try:
+                    value = enum_clean(ACTION_PROPERTIES[key], ast.literal_eval(assign.group(3)))
+                except (ValueError, KeyError, TypeError, SyntaxError):
+                    raise Exception("Bad value for '{}' in '{}'".format(key, string))
 
-    def __setitem__(self, key, value):
-        self.props[key] = value
+                operation = SetOperation(index, key, value)
+            else:
+                raise Exception("Cannot parse '{}' in '{}'".format(statement, string))
+
+            if index >= pattern_len:
+                raise Exception("p[{}] is outside of the pattern in '{}'".format(index, string))
+
+            operations.append(operation)
 
-    def __getitem__(self, key):
-        return self.props[key]
+        return RuleAction(string, operations)
 
-    def to_phoneme(self):
-        return None if self.deleted else self.type(**self.props)
+    def apply(self, p):
+        # Each phoneme is only rebuilt once every operation has run, so a rule can set a property that phoneme doesn't
+        # have (a consonant's manner on a vowel) and then remove it
+        changes = {}
+        for operation in self.operations:
+            operation.apply(p, changes)
+
+        for index, values in changes.items():
+            if p[index] is not None:  # Changes to removed phonemes are ignored
+                p[index] = p[index].replace(**values)
+
+    def __str__(self):
+        return self.text
 
 
 class Rule:
-    def __init__(self, pattern, action):
+    def __init__(self, pattern, action, mode=ApplyMode.first):
         self.pattern = pattern
-        self.action = compile(action, "<string>", "exec")
+        self.action = RuleAction.from_string(action, len(pattern.pattern))
+        self.mode = mode
 
     @staticmethod
     def from_string(string):
@@ -159,54 +314,289 @@ class Rule:
         pattern = pattern.strip()
         action = action.strip()
 
+        mode = ApplyMode.first
+        if not pattern.startswith("("):  # Optional mode prefix, "all: (VOW)(VOW)"
+            mode_name, _, pattern = pattern.partition(":")
+            try:
+                mode = ApplyMode[mode_name.strip().lower()]
+            except KeyError:
+                raise Exception("Unknown rule mode '{}' in '{}'".format(mode_name, string.strip()))
+            pattern = pattern.strip()
+
         phoneme_pattern = PhonemePattern.from_string(pattern)
 
-        return Rule(phoneme_pattern, action)
+        return Rule(phoneme_pattern, action, mode)
+
+    def apply(self, phonemes, stats: "RuleStats"=None):
+        """Changes phonemes in place, returns True if the rule matched. Counts and timings go to stats if given"""
+        if stats is not None:
+            return self._apply_profiled(phonemes, stats)
+
+        if self.mode == ApplyMode.first:
+            index, length = self.pattern.match(phonemes)
 
-    def apply(self, phonemes):
-        index, length = self.pattern.match(phonemes)
+            if index == -1:
+                return False  # No match
 
-        if index == -1:
-            return False  # No match
+            self._apply_at(phonemes, index)
+            return True
 
-        p = []
+        if self.mode == ApplyMode.all:
+            return self._apply_all(phonemes)
 
-        for i in range(index, index + length):
-            phoneme = phonemes[i]
-            mrp = MutableRulePhoneme(phoneme)
-            p.append(mrp)
+        return self._apply_fixpoint(phonemes)
 
-        exec(self.action)
+    def could_match(self, code_bits):
+        """False if the pattern can't match a word made of only these phoneme codes, a bitset as in RuleTrace"""
+        return all(phoneme_match.code_bits & code_bits for phoneme_match in self.pattern.pattern)
 
-        for i in range(0, length):
-            p_i = i + index
-            phoneme = p[i].to_phoneme()
+    def _apply_profiled(self, phonemes, stats):
+        stats.attempts += 1
+
+        if self.mode == ApplyMode.first:
+            start = perf_counter()
+            index, length = self.pattern.match(phonemes)
+            stats.match_time += perf_counter() - start
+
+            fired = index != -1
+            if fired:
+                self._apply_at(phonemes, index, stats)
+        elif self.mode == ApplyMode.all:
+            fired = self._apply_all(phonemes, stats)
+        else:
+            fired = self._apply_fixpoint(phonemes, stats)
+
+        if fired:
+            stats.fired += 1
+
+        return fired
+
+    def _apply_fixpoint(self, phonemes, stats=None):
+        state = phonemes.code_text
+        seen = set()
+        fired = False
+
+        while True:
+            seen.add(state)
+
+            if not self._apply_all(phonemes, stats):
+                return fired
+
+            fired = True
+            new_state = phonemes.code_text
+
+            if new_state == state:
+                return fired  # Still matches, but the word doesn't change anymore
+            if new_state in seen:
+                raise Exception("Rule {} never settles on {}".format(self, phonemes))
+
+            state = new_state
+
+    def _apply_all(self, phonemes, stats=None):
+        length = len(self.pattern.pattern)
+        indices = []
+
+        if stats is None:
+            matches = self.pattern.match_all(phonemes)
+        else:
+            start = perf_counter()
+            matches = self.pattern.match_all(phonemes)
+            stats.match_time += perf_counter() - start
 
-            if phoneme:
-                phonemes[p_i] = phoneme
+        for index in matches:
+            if not indices or index >= indices[-1] + length:
+                indices.append(index)
+
+        # Right to left, so removals don't move the matches still to be changed
+        for index in reversed(indices):
+            self._apply_at(phonemes, index, stats)
+
+        return len(indices) > 0
+
+    def _apply_at(self, phonemes, index, stats=None):
+        if stats is not None:
+            start = perf_counter()
+
+        length = len(self.pattern.pattern)
+        p = [phonemes[i] for i in range(index, index + length)]
+
+        self.action.apply(p)
+
+        if stats is not None:
+            stats.matches += 1
+            for i in range(0, length):
+                if p[i] is None:
+                    stats.deleted += 1
+                elif p[i] is not phonemes[index + i]:  # Phonemes are interned, the same sound is the same object
+                    stats.changed += 1
+
+        # Backwards, so removals don't shift the phonemes still to be written
+        for i in range(length - 1, -1, -1):
+            if p[i] is None:
+                del phonemes[index + i]
             else:
-                index -= 1
-                del phonemes[p_i]
+                phonemes[index + i] = p[i]
 
-        return True
+        if stats is not None:
+            stats.action_time += perf_counter() - start
 
     def __str__(self):
-        return "{}\t{}".format(str(self.pattern), self.action)
+        mode = "" if self.mode == ApplyMode.first else "{}: ".format(self.mode.name)
+        return "{}{}\t{}".format(mode, str(self.pattern), self.action)
 
     def __repr__(self):
         return self.__str__()
 
 
+class RuleTrace:
+    """
+    What happened while rules were applied to a word, used to tell which words a rule change can affect. Every word
+    keeps one, so it is kept small
+    """
+    __slots__ = ("fired", "codes")
+
+    def __init__(self, fired=(), codes=0):
+        self.fired = fired  # Indices of the rules that matched, in the RuleSet that was applied
+        self.codes = codes  # Bitset of every phoneme code the word had before, between and after rules
+
+    @staticmethod
+    def code_bits(codes) -> int:
+        bits = 0
+        for code in set(codes):
+            bits |= 1 << code
+        return bits
+
+
+class RuleStats:
+    """Counts and timings of one rule, see RuleSet.enable_profiling"""
+    def __init__(self):
+        self.attempts = 0       # Words the rule was tried on
+        self.fired = 0          # Words it matched
+        self.matches = 0        # Places it changed, "all" and "fixpoint" rules can change many per word
+        self.deleted = 0        # Phonemes removed
+        self.changed = 0        # Phonemes that became a different phoneme
+        self.match_time = 0.0   # Seconds spent finding matches
+        self.action_time = 0.0  # Seconds spent changing them
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class RuleProfile:
+    """RuleStats for every rule in a RuleSet, in the order the rules are applied"""
+    def __init__(self, rules: List[Rule]):
+        self.stats = {rule: RuleStats() for rule in rules}
+
+    def __getitem__(self, rule: Rule) -> RuleStats:
+        return self.stats[rule]
+
+    def dead_rules(self):
+        """Rules that never matched"""
+        return [rule for rule, stats in self.stats.items() if stats.fired == 0]
+
+    def report(self, sort_by_time=True):
+        """Text table of every rule, slowest first unless sort_by_time is False"""
+        rows = list(enumerate(self.stats.items()))
+        if sort_by_time:
+            rows.sort(key=lambda row: -(row[1][1].match_time + row[1][1].action_time))
+
+        lines = ["{:>4} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10} {:>10}  {}".format(
+            "#", "tried", "fired", "matches", "deleted", "changed", "match ms", "action ms", "rule")]
+
+        for i, (rule, stats) in rows:
+            lines.append("{:>4} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10.2f} {:>10.2f}  {}{}".format(
+                i, stats.attempts, stats.fired, stats.matches, stats.deleted, stats.changed,
+                stats.match_time * 1000, stats.action_time * 1000, str(rule).replace("\t", "  "),
+                "  (never fired)" if stats.fired == 0 else ""))
+
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {"rules": [dict(stats.to_dict(), index=i, rule=str(rule))
+                          for i, (rule, stats) in enumerate(self.stats.items())]}
+
+    def to_json(self, indent=1):
+        return json.dumps(self.to_dict(), indent=indent, ensure_ascii=False)
+
+
 class RuleSet:
     def __init__(self, rules: List[Rule]):
         self.rules = rules
+        self.version = 0
+        self.profile = None  # RuleProfile while profiling, see enable_profiling
+
+    def __getstate__(self):
+        # Profiles only cover this process, they aren't saved in snapshots or sent to workers
+        state = self.__dict__.copy()
+        state["profile"] = None
+        return state
+
+    def enable_profiling(self) -> RuleProfile:
+        """
+        Starts counting how often every rule is tried, matches and changes phonemes, and how long it takes. Only words
+        derived in this process from now on are counted, see Language.profile_rules. Returns the new RuleProfile
+        """
+        self.profile = RuleProfile(self.rules)
+        return self.profile
+
+    def disable_profiling(self):
+        self.profile = None
 
     def add_rule(self, rule: Rule):
         self.rules.append(rule)
+        self.version += 1
+
+    def apply(self, phonemes: Phonemes, trace: RuleTrace=None):
+        if self.profile is not None:
+            return self._apply_profiled(phonemes, trace)
+
+        if trace is None:
+            for rule in self.rules:
+                rule.apply(phonemes)
+            return
+
+        fired = []
+        codes = set(phonemes.codes)
+
+        for i, rule in enumerate(self.rules):
+            if rule.apply(phonemes):
+                fired.append(i)
+                codes.update(phonemes.codes)
+
+        trace.fired = tuple(fired)
+        trace.codes = RuleTrace.code_bits(codes)
+
+    def _apply_profiled(self, phonemes, trace):
+        stats = self.profile.stats
+        fired = []
+        codes = set(phonemes.codes)
+
+        for i, rule in enumerate(self.rules):
+            if rule.apply(phonemes, stats.setdefault(rule, RuleStats())):
+                fired.append(i)
+                codes.update(phonemes.codes)
+
+        if trace is not None:
+            trace.fired = tuple(fired)
+            trace.codes = RuleTrace.code_bits(codes)
+
+    def diff(self, other: "RuleSet"):
+        """
+        Rules removed from and added to this set to get other, unchanged rules are compared by their text.
+        Unchanged rules in other are replaced with the ones from this set, so rules can be told apart by identity
+        """
+        matcher = difflib.SequenceMatcher(None, list(map(str, self.rules)), list(map(str, other.rules)), autojunk=False)
+        removed = set(self.rules)
+        added = set(other.rules)
+
+        for a, b, size in matcher.get_matching_blocks():
+            for i in range(0, size):
+                removed.discard(self.rules[a + i])
+                added.discard(other.rules[b + i])
+                other.rules[b + i] = self.rules[a + i]
+
+        return removed, added
 
-    def apply(self, phonemes: Phonemes):
-        for rule in self.rules:
-            rule.apply(phonemes)
 
 """
 r = Rule.from_string('(VOW)(VOW)          p[1].rem() ; p[0]["length"] = "long"')
@@ -0,0 +1,192 @@
+"""
+Compiled snapshots of a language, so that it can be loaded without parsing the sources or deriving every word again.
+
+A snapshot is a header, a pickle of everything except phonemes, and then the phoneme codes of every morpheme and
+derived word in one block. The block is memory mapped when the snapshot is read, and the phonemes are views into it.
+"""
+import gc
+import mmap
+import os
+import pickle
+import struct
+import sys
+from array import array
+
+from dictionary import Morpheme, Word
+from phoneme import Ipa, Phonemes, PHONEME_COUNT
+from rules import RuleTrace
+
+MAGIC = b"LEXS"
+VERSION = 1  # Change whenever the format changes, older snapshots are then ignored
+_HEADER = struct.Struct("<4sHBxIQ")  # magic, version, little endian, phoneme count, pickle size
+_ALIGN = 8
+
+
+def is_fresh(lang_path, snapshot_path, sources):
+    """
+    True if the snapshot exists and is newer than every one of the sources, and the IPA tables its IPA was made with
+    """
+    try:
+        modified = os.stat(snapshot_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+    paths = [lang_path + "/" + source for source in sources] + [os.path.join(Ipa.path, file) for file in Ipa.FILES]
+    return all(os.stat(path).st_mtime_ns <= modified for path in paths)
+
+
+def write(lang, path):
+    """Writes a snapshot of lang to path, replacing it in one step so that open snapshots stay valid"""
+    dictionary = lang.dictionary
+    block = array("H")
+
+    def span(phonemes: Phonemes):
+        start = len(block)
+        block.extend(phonemes.codes)
+        return start, len(block) - start
+
+    morphemes = list(dictionary.morphemes.items())
+    morpheme_indices = {morpheme: i for i, (_, morpheme) in enumerate(morphemes)}
+
+    words = []
+    for word in dictionary.words:
+        indices = [morpheme_indices[morpheme] for morpheme in word.morphemes]
+
+        try:
+            derivation = word.derivation
+        except Exception as e:
+            words.append((indices, word.definitions, None, None, e))
+            continue
+
+        trace = derivation.trace
+        if trace is not None:
+            trace = trace.fired, trace.codes
+
+        phonemes = span(derivation.raw_phonemes), span(derivation.phonemes), derivation.ipa
+        words.append((indices, word.definitions, phonemes, trace, None))
+
+    word_indices = {word: i for i, word in enumerate(dictionary.words)}
+
+    data = pickle.dumps({
+        "romanization": lang.romanization,
+        "syllable_data": lang.syllable_data,
+        "rules": lang.rules,
+        "morphemes": [(tag, morpheme.text, morpheme.definitions, span(morpheme.prefix), span(morpheme.postfix))
+                      for tag, morpheme in morphemes],
+        "words": words,
+        "free_words": {tag: word_indices[word] for tag, word in dictionary.free_words.items()},
+        "sorted_words": [word_indices[word] for word in dictionary],
+    }, pickle.HIGHEST_PROTOCOL)
+
+    if sys.byteorder != "little":
+        block.byteswap()
+
+    header = _HEADER.pack(MAGIC, VERSION, 1, PHONEME_COUNT, len(data))
+    padding = -(len(header) + len(data)) % _ALIGN
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(header)
+        f.write(data)
+        f.write(bytes(padding))
+        f.write(block.tobytes())
+
+    os.replace(temp_path, path)
+
+
+def read(lang, path):
+    """
+    Loads the snapshot at path into lang. Returns False, without changing lang, if it was written by a different
+    version of Lexicon or can't be read
+    """
+    # Nothing made here is garbage, and collecting while making this many objects triples the time it takes
+    enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        return _read(lang, path)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _read(lang, path):
+    try:
+        loaded = _load(lang, path)
+    except Exception:
+        return False  # Damaged, or pickled with classes that have changed since
+
+    if loaded is None:
+        return False
+
+    # Nothing above touched lang, so it is only changed once everything has been read
+    data, words, derivations, morphemes, free_words, sorted_words = loaded
+
+    lang.romanization = data["romanization"]
+    lang.syllable_data = data["syllable_data"]
+    lang.rules = data["rules"]
+
+    for word, derivation in zip(words, derivations):
+        if isinstance(derivation, Exception):
+            word.set_error(derivation)
+        else:
+            word.set_derivation(*derivation)
+
+    lang.dictionary.restore(morphemes, free_words, words, sorted_words)
+
+    return True
+
+
+def _load(lang, path):
+    """Everything in the snapshot at path, or None if it is for a different version. Words are made but not derived"""
+    with open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return None
+
+        magic, version, little, phoneme_count, data_size = _HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or phoneme_count != PHONEME_COUNT:
+            return None
+
+        data = pickle.loads(f.read(data_size))
+        start = _HEADER.size + data_size
+        start += -start % _ALIGN
+
+        if sys.byteorder == "little" and os.fstat(f.fileno()).st_size > start:
+            block = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))[start:].cast("H")
+        else:
+            f.seek(start)
+            block = array("H")
+            block.frombytes(f.read())
+            if sys.byteorder != "little":
+                block.byteswap()
+
+    def view(span):
+        if span[0] + span[1] > len(block):
+            raise Exception("Phonemes {} are past the end of the snapshot".format(span))
+        return Phonemes.from_codes(block[span[0]:span[0] + span[1]])
+
+    morphemes = {}
+    for tag, text, definitions, prefix, postfix in data["morphemes"]:
+        morphemes[tag] = Morpheme(view(prefix), view(postfix), definitions, text)
+
+    morpheme_list = list(morphemes.values())
+    words = []
+    derivations = []  # (phonemes, trace, raw phonemes, ipa) for Word.set_derivation, or the error
+    for indices, definitions, phonemes, trace, error in data["words"]:
+        words.append(Word(lang, [morpheme_list[i] for i in indices], definitions))
+
+        if error is not None:
+            derivations.append(error)
+            continue
+
+        if trace is not None:
+            trace = RuleTrace(*trace)
+
+        raw, surface, ipa = phonemes
+        derivations.append((view(surface), trace, view(raw), ipa))
+
+    free_words = {tag: words[i] for tag, i in data["free_words"].items()}
+    sorted_words = [words[i] for i in data["sorted_words"]]
+
+    return data, words, derivations, morphemes, free_words, sorted_words
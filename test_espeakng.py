@@ -0,0 +1,52 @@
+import os
+import struct
+import unittest
+
+from espeakng import ESpeakNG
+
+FAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_espeak_ng.py')
+
+
+class ESpeakNGTest(unittest.TestCase):
+    """Runs espeakng.py against fake_espeak_ng.py, so it needs neither espeak-ng nor audio hardware"""
+    def setUp(self):
+        self.espeak = ESpeakNG(executable=FAKE, workers=2)
+
+    def tearDown(self):
+        self.espeak.close()
+
+    def test_synth_wav_sizes(self):
+        for txt in ['hello', 'hello world, again']:
+            wav = self.espeak.synth_wav(txt)
+            data = wav.find(b'data', 12)
+            self.assertTrue(wav.startswith(b'RIFF'))
+            self.assertEqual(struct.unpack('<I', wav[4:8])[0], len(wav) - 8)
+            self.assertEqual(struct.unpack('<I', wav[data + 4:data + 8])[0], len(wav) - data - 8)
+
+    def test_g2p_batch_aligned(self):
+        texts = ['Hello world', '3.5', '', 'a, b', 'plain', ' ', 'two\nlines']
+        self.assertEqual(self.espeak.g2p_batch(texts, batch_size=3), [self.espeak.g2p(txt) for txt in texts])
+
+    def test_close(self):
+        self.espeak.synth_wav('hello')
+        waiting = [p for waiting in self.espeak._pool._waiting.values() for p in waiting]
+        self.assertTrue(waiting)
+        self.espeak.close()
+        self.assertFalse(self.espeak._pool._waiting)
+        self.assertTrue(all(p.poll() is not None for p in waiting))
+
+    def test_batch_processes(self):
+        spawned = []
+        spawn = self.espeak._pool._spawn
+        self.espeak._pool._spawn = lambda cmd, stderr: spawned.append(spawn(cmd, stderr)) or spawned[-1]
+
+        self.espeak.synth_batch(['text %d' % i for i in range(20)])
+        self.espeak.g2p_batch(['text %d' % i for i in range(20)], batch_size=5)
+        self.assertLessEqual(sum(map(len, self.espeak._pool._waiting.values())), self.espeak._pool.size)
+
+        self.espeak.close()
+        self.assertTrue(all(p.poll() is not None for p in spawned))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import itertools
+import os
+import random
+import re
+import unittest
+
+from language import Language, SyllableData
+from phoneme import Ipa, Phonemes
+from rules import Rule, RuleSet
+
+LANG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lang1")
+
+
+def derived(lang):
+    """Every word's surface phoneme codes, or its error"""
+    results = []
+    for word in lang.dictionary.words:
+        try:
+            results.append(tuple(word.phonemes.codes))
+        except Exception as e:
+            results.append(str(e))
+    return results
+
+
+class SyllableTest(unittest.TestCase):
+    """The linear syllabifier against the regular expression it replaced, on every short word"""
+    @staticmethod
+    def regex_syllables(ps, req_onsets, opt_onsets, req_codas, opt_codas):
+        regex = re.compile("^(c{{{},{}}}vc{{{},{}}}?)+$".format(req_onsets, req_onsets + opt_onsets,
+                                                              req_codas, req_codas + opt_codas))
+        cv = "".join("v" if p.has_prop("vowel") else "c" for p in ps)
+        ranges = []
+        end = len(cv)
+
+        while cv:
+            match = regex.match(cv)
+            if not match:
+                return None
+            length = len(match.group(1))
+            ranges.insert(0, range(end - length, end))
+            end -= length
+            cv = cv[:-length]
+
+        return ranges
+
+    def test_every_word(self):
+        vowel, consonant = Ipa.ipa_to_phoneme("a"), Ipa.ipa_to_phoneme("t")
+
+        for req_onsets, opt_onsets, req_codas, opt_codas in itertools.product(range(3), repeat=4):
+            syllable_data = SyllableData(opt_onsets, req_onsets, opt_codas, req_codas, None, None)
+
+            for length in range(0, 9):
+                for vowels in itertools.product([False, True], repeat=length):
+                    ps = Phonemes([vowel if is_vowel else consonant for is_vowel in vowels])
+                    expected = self.regex_syllables(ps, req_onsets, opt_onsets, req_codas, opt_codas)
+
+                    try:
+                        ranges = syllable_data.syllable_ranges(ps)
+                    except Exception:
+                        ranges = None
+
+                    self.assertEqual(ranges, expected, (req_onsets, opt_onsets, req_codas, opt_codas, vowels))
+
+
+class RederiveTest(unittest.TestCase):
+    """Incremental rederive after random rule edits against deriving every word from scratch"""
+    EXTRA_RULES = ['(*a)(*t)  p[1]["voicing"] = "voiced"', 'all: (VOW)  p[0]["length"] = "long"', '(*t)  p[0].rem()',
+                   '(CONS)(CONS)  p[0].rem()', 'fixpoint: (VOW)(VOW)  p[1].rem()']
+
+    def test_random_rule_edits(self):
+        lang = Language(LANG, use_snapshot=False)
+        lang.derive_all(1)
+
+        with open(os.path.join(LANG, "rules.txt"), encoding="utf-8") as f:
+            texts = [line.rstrip("\n") for line in f if line.strip()]
+
+        rng = random.Random(1)
+        for step in range(30):
+            edit = rng.choice(["remove", "insert", "move"])
+            if edit == "remove" and len(texts) > 1:
+                texts.pop(rng.randrange(len(texts)))
+            elif edit == "insert":
+                texts.insert(rng.randrange(len(texts) + 1), rng.choice(texts + self.EXTRA_RULES))
+            elif len(texts) > 1:
+                texts.insert(rng.randrange(len(texts)), texts.pop(rng.randrange(len(texts))))
+
+            lang.update_rules(RuleSet([Rule.from_string(text) for text in texts]))
+
+            rebuilt = Language(LANG, use_snapshot=False)
+            rebuilt.rules = RuleSet([Rule.from_string(text) for text in texts])
+
+            self.assertEqual(derived(lang), derived(rebuilt), (step, texts))
+            for word in lang.dictionary.words:
+                if word.trace is not None:
+                    self.assertTrue(all(0 <= i < len(lang.rules.rules) for i in word.trace.fired))
+
+    def test_unchanged_failures_not_reported(self):
+        lang = Language(LANG, use_snapshot=False)
+        with open(os.path.join(LANG, "rules.txt"), encoding="utf-8") as f:
+            texts = [line.rstrip("\n") for line in f if line.strip()]
+
+        # Words left without a vowel can't be split into syllables
+        texts.append("fixpoint: (*a)  p[0].rem()")
+        lang.update_rules(RuleSet([Rule.from_string(text) for text in texts]))
+        failing = set(word for word, error in zip(lang.dictionary.words, derived(lang)) if isinstance(error, str))
+        self.assertTrue(failing)
+
+        # Could match every word that had an a, so those are derived again, and still fail
+        texts.append('(*a)  p[0]["length"] = "long"')
+        changes = lang.update_rules(RuleSet([Rule.from_string(text) for text in texts]))
+        self.assertFalse(failing & set(word for word, _, _ in changes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import random
+import unittest
+
+from phoneme import Ipa, Phonemes
+from rules import PhonemePattern, Rule
+
+
+def phonemes(ipa):
+    return Phonemes([Ipa.ipa_to_phoneme(c) for c in ipa])
+
+
+class RuleActionTest(unittest.TestCase):
+    def apply(self, rule, ipa):
+        ps = phonemes(ipa)
+        Rule.from_string(rule).apply(ps)
+        return ps.ipa
+
+    def test_set_then_remove(self):
+        # A consonant property on a vowel is fine, as long as the vowel is removed
+        self.assertEqual(self.apply('(CLOSE)  p[0]["manner"] = "plosive" ; p[0].rem()', "kit"), "kt")
+
+    def test_set_after_remove(self):
+        self.assertEqual(self.apply('(VOW)  p[0].rem() ; p[0]["length"] = "long"', "kit"), "kt")
+
+    def test_last_set_wins(self):
+        self.assertEqual(self.apply('(VOW)  p[0]["height"] = "open" ; p[0]["height"] = "close_mid"', "kit"), "ket")
+
+    def test_set_and_remove_others(self):
+        self.assertEqual(self.apply('(VOW)(VOW)  p[1].rem() ; p[0]["length"] = "long"', "tao"), "taː")
+
+
+class PhonemePatternTest(unittest.TestCase):
+    """The compiled regular expressions against trying every position with PhonemeMatch.matches"""
+    KEYS = ["VOW", "CONS", "PLO", "NAS", "FRONT", "BACK", "CLOSE", "OPEN", "VELAR", "UNSTRESSED", "STRESSED", "START",
+            "END", "SIB", "OBS", "SON", "VOICED", "APPROX", "*t", "*a", "*e", "*x", "*ə", "*aː"]
+    INVENTORY = ["ə", "a", "e", "i", "o", "u", "t", "k", "x", "m", "n", "s", "ŋ", "aː", "b", "d"]
+
+    @staticmethod
+    def match_all(pattern, ps):
+        length = len(pattern.pattern)
+        return [start for start in range(0, len(ps) - length + 1)
+                if all(pattern.pattern[i].matches(ps[start + i], start + i == 0, start + i == len(ps) - 1)
+                       for i in range(length))]
+
+    def random_filter(self, rng):
+        key = rng.choice(self.KEYS)
+        return key if key.startswith("*") else rng.choice(["", "!"]) + key
+
+    def test_random_patterns(self):
+        rng = random.Random(1)
+        inventory = [Ipa.ipa_to_phoneme(ipa) for ipa in self.INVENTORY]
+
+        for _ in range(300):
+            text = "".join("({})".format(" ".join(self.random_filter(rng) for _ in range(rng.randint(1, 3))))
+                           for _ in range(rng.randint(1, 4)))
+            pattern = PhonemePattern.from_string(text)
+
+            for _ in range(10):
+                ps = Phonemes([rng.choice(inventory).with_stress(rng.randint(0, 2)) for _ in range(rng.randint(0, 9))])
+                expected = self.match_all(pattern, ps)
+
+                self.assertEqual(pattern.match_all(ps), expected, (text, ps.ipa))
+                self.assertEqual(pattern.match(ps), (expected[0], len(pattern.pattern)) if expected else (-1, -1))
+
+
+if __name__ == '__main__':
+    unittest.main()
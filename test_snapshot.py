@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import snapshot
+from language import Language
+from rules import Rule, RuleSet
+
+LANG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lang1")
+
+
+def contents(lang):
+    """Everything a snapshot stores about the words, in the order they are listed and sorted in"""
+    words = []
+    for word in lang.dictionary.words:
+        try:
+            derivation = tuple(word.raw_phonemes.codes), tuple(word.phonemes.codes), word.ipa
+        except Exception as e:
+            derivation = str(e)
+        trace = word.trace
+        words.append(([morpheme.text for morpheme in word.morphemes], word.definitions, derivation,
+                      None if trace is None else (tuple(trace.fired), trace.codes)))
+
+    return words, [str(word) for word in lang.dictionary], sorted(lang.dictionary.free_words)
+
+
+class SnapshotTest(unittest.TestCase):
+    """Languages loaded from a snapshot against the same language loaded from its sources"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "lang")
+        shutil.copytree(LANG, self.path)
+        self.snapshot_path = os.path.join(self.path, Language.SNAPSHOT)
+
+        self.sources = Language(self.path, use_snapshot=False)
+        self.sources.derive_all(1)
+        Language.compile(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        self.assertTrue(snapshot.is_fresh(self.path, self.snapshot_path, Language.FILES.values()))
+        lang = Language(self.path)
+        self.assertEqual(contents(lang), contents(self.sources))
+
+        for tag in self.sources.dictionary.free_words:
+            morpheme = self.sources.dictionary.get_morpheme(tag)
+            for raw in (False, True):
+                self.assertEqual([word.definitions for word in lang.dictionary.get_words(morpheme.text, raw)],
+                                 [word.definitions for word in self.sources.dictionary.get_words(morpheme.text, raw)])
+
+    def test_rule_change_after_load(self):
+        # Traces read from the snapshot decide which words are derived again
+        with open(os.path.join(self.path, "rules.txt"), encoding="utf-8") as f:
+            texts = [line.rstrip("\n") for line in f if line.strip()]
+        texts = texts[1:] + ['(*a)(*t)  p[1]["voicing"] = "voiced"']
+
+        lang = Language(self.path)
+        for language in (lang, self.sources):
+            language.update_rules(RuleSet([Rule.from_string(text) for text in texts]))
+
+        self.assertEqual(contents(lang), contents(self.sources))
+
+    def test_stale(self):
+        stat = os.stat(self.snapshot_path)
+        os.utime(os.path.join(self.path, "rules.txt"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertFalse(snapshot.is_fresh(self.path, self.snapshot_path, Language.FILES.values()))
+
+    def test_damaged(self):
+        size = os.path.getsize(self.snapshot_path)
+
+        for keep in (0, 10, size // 2, size - 8):
+            with open(self.snapshot_path, "r+b") as f:
+                data = f.read()
+                f.seek(0)
+                f.truncate(keep)
+                f.write(data[:keep])
+
+            self.assertEqual(contents(Language(self.path)), contents(self.sources), keep)
+            Language.compile(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,20 @@
+import asyncio
+import shutil
+import subprocess
+
 import espeakng
 import kiershenbaum as kiersh
 
+# Commands that play a WAV from stdin, the first one installed is used
+PLAYERS = [["paplay"], ["aplay", "-q"]]
+
 
 class TTS:
-    def __init__(self):
-        self.espeakng = espeakng.ESpeakNG()
+    def __init__(self, executable='espeak-ng', workers=1, cache=None):
+        """cache is a WavCache, everything is then synthesized through it and played with one of PLAYERS"""
+        self.espeakng = espeakng.ESpeakNG(executable=executable, workers=workers)
+        self.cache = cache
+        self.player = next((p for p in PLAYERS if shutil.which(p[0])), None)
         self.espeakng.voice = "en+f4"
         self.espeakng.speed = 110
         self.espeakng.word_gap = 5
@@ -19,9 +29,162 @@ class TTS:
         self.espeakng.say(text, True)
 
     def say_kiershenbaum(self, kiershenbaum):
-        kiershenbaum = kiershenbaum.replace("&", "a")  # "&" doesn't send nicely over command line, "a" is close enough
-        self.espeakng.say(kiershenbaum, True, True)
+        if self.cache is not None and self.player is not None:
+            subprocess.run(self.player, input=self.synth_kiershenbaum(kiershenbaum), check=True)
+        else:
+            self.espeakng.say(self._clean(kiershenbaum), True, True)
+
+    def synth_ipa(self, ipa):
+        """WAV of the ipa being said"""
+        return self.synth_kiershenbaum(self.ipa_to_kiershenbaum(ipa))
+
+    def synth_kiershenbaum(self, kiershenbaum):
+        if self.cache is not None:
+            return self.cache.synth(self.espeakng, self._clean(kiershenbaum), fmt='xs')
+
+        return self.espeakng.synth_wav(self._clean(kiershenbaum), fmt='xs')
+
+    def export_ipa(self, ipa, path):
+        """Saves the WAV of ipa being said to path"""
+        with open(path, "wb") as f:
+            f.write(self.synth_ipa(ipa))
+
+    @staticmethod
+    def _clean(kiershenbaum):
+        return kiershenbaum.replace("&", "a")  # "&" doesn't send nicely over command line, "a" is close enough
 
     @staticmethod
     def ipa_to_kiershenbaum(ipa):
         return kiersh.unicode_to_ascii(ipa)
+
+
+class AsyncTTS:
+    """
+    Says things in the background with asyncio. Everything said is queued, and while one thing is playing the next
+    ones are converted and synthesized, up to ahead of them. Use it with async with, or call start() and close().
+    Without an audio player espeak-ng plays everything itself, which can't be stopped part way through
+    """
+    def __init__(self, tts: TTS=None, player=None, ahead=2):
+        self.tts = TTS() if tts is None else tts
+        self.player = player if player is not None else self.tts.player
+        self.ahead = ahead
+        self._pending = None  # Waiting to be synthesized
+        self._synthesized = None  # Waiting to be played
+        self._futures = set()
+        self._tasks = []
+        self._playing = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def start(self):
+        self._pending = asyncio.Queue()
+        self._synthesized = asyncio.Queue(self.ahead)
+        self._tasks = [asyncio.ensure_future(self._synthesize_loop()), asyncio.ensure_future(self._play_loop())]
+
+    def say_ipa(self, ipa) -> asyncio.Future:
+        """Queues ipa to be said, the returned future is done once it has been played"""
+        return self._queue(ipa, True)
+
+    def say_kiershenbaum(self, kiershenbaum) -> asyncio.Future:
+        return self._queue(kiershenbaum, False)
+
+    def _queue(self, text, ipa):
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(self._futures.discard)
+        self._futures.add(future)
+        self._pending.put_nowait((text, ipa, future))
+        return future
+
+    def cancel(self):
+        """Stops what is playing, and drops everything that is queued"""
+        for future in list(self._futures):
+            future.cancel()
+
+        if self._playing is not None and self._playing.returncode is None:
+            self._playing.kill()
+
+    async def join(self):
+        """Waits until everything queued has been played or cancelled"""
+        if self._futures:
+            await asyncio.wait(list(self._futures))
+
+    async def close(self):
+        self.cancel()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _synthesize(self, text, ipa):
+        kiershenbaum = self.tts.ipa_to_kiershenbaum(text) if ipa else text
+
+        if self.player is None:
+            return kiershenbaum  # Left to espeak-ng to play
+
+        return self.tts.synth_kiershenbaum(kiershenbaum)
+
+    async def _synthesize_loop(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            text, ipa, future = await self._pending.get()
+            if future.done():
+                continue  # Cancelled while waiting
+
+            try:
+                sound = await loop.run_in_executor(None, self._synthesize, text, ipa)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+
+            await self._synthesized.put((sound, future))
+
+    async def _play_loop(self):
+        while True:
+            sound, future = await self._synthesized.get()
+            if future.done():
+                continue
+
+            if self.player is None:
+                await self._say(sound, future)
+                continue
+
+            try:
+                self._playing = await asyncio.create_subprocess_exec(*self.player,
+                                                                     stdin=asyncio.subprocess.PIPE,
+                                                                     stdout=asyncio.subprocess.DEVNULL,
+                                                                     stderr=asyncio.subprocess.DEVNULL)
+                try:
+                    await self._playing.communicate(sound)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # Killed by cancel
+
+                code = self._playing.returncode
+                if not future.done():
+                    if code != 0:
+                        future.set_exception(Exception("{} exited with {}".format(self.player[0], code)))
+                    else:
+                        future.set_result(None)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._playing = None
+
+    async def _say(self, kiershenbaum, future):
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.tts.say_kiershenbaum, kiershenbaum)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+
+        if not future.done():
+            future.set_result(None)
@@ -1,6 +1,12 @@
+import asyncio
+import os
+import sys
+import threading
+
 from dictionary import Word
 from language import *
-from tts import TTS
+from tts import TTS, AsyncTTS
+from watcher import LanguageWatcher
 
 
 lang = Language("lang1")
@@ -20,23 +26,78 @@ for word in lang.dictionary:
 #ipa = str(word)
 #tts.say_ipa(ipa)
 
-tts = TTS()
-while True:
-    try:
-        command = input(": ")
+watcher = LanguageWatcher(lang)
+
+
+def read_lines(loop, lines):
+    """
+    Reads stdin on a daemon thread, an executor thread would keep Ctrl-C from exiting until Enter is pressed. It reads
+    its own copy of stdin, as Python can't shut down cleanly while a thread is blocked reading sys.stdin
+    """
+    def put(line):
+        try:
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        except RuntimeError:
+            pass  # The loop has already closed
+
+    def read():
+        with open(os.dup(sys.stdin.fileno()), encoding=sys.stdin.encoding) as stdin:
+            for line in stdin:
+                put(line.rstrip("\n"))
+        put(None)  # End of input
+
+    threading.Thread(target=read, daemon=True).start()
+
+
+async def read_line(lines, prompt):
+    print(prompt, end="", flush=True)
+    line = await lines.get()
+
+    if line is None:
+        raise EOFError()
+
+    return line
+
+
+def report_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        print("Could not say it: {}".format(future.exception()))
+
+
+async def repl():
+    lines = asyncio.Queue()
+    read_lines(asyncio.get_event_loop(), lines)
+
+    # Words are spoken in the background, so the next command can be typed while the last one is still being said
+    async with AsyncTTS(tts) as speaker:
+        while True:
+            try:
+                command = await read_line(lines, ": ")
+
+                # Pick up any edits made to the language files since the last command
+                for name, changes, error in watcher.poll():
+                    if error is not None:
+                        print("Could not reload {}: {}".format(lang.file_path(name), error))
+                        continue
+
+                    print("Reloaded {}, {} words changed".format(lang.file_path(name), len(changes)))
 
-        words = command.split(" ")
+                words = command.split(" ")
 
-        all_ipa = []
+                all_ipa = []
 
-        for word in words:
-            word = lang.dictionary.to_word(word.split("+"), [])
-            all_ipa.append(word.ipa)
-            print(word.phonemes)
-            print(lang.romanization.phonemes_to_roman(word.phonemes))
+                for word in words:
+                    word = lang.dictionary.to_word(word.split("+"), [])
+                    all_ipa.append(word.ipa)
+                    print(word.phonemes)
+                    print(lang.romanization.phonemes_to_roman(word.phonemes))
 
-        tts.say_ipa(" ".join(all_ipa))
-    except Exception as e:
-        print(e)
+                speaker.say_ipa(" ".join(all_ipa)).add_done_callback(report_error)
+            except EOFError:
+                print()
+                break
+            except Exception as e:
+                print(e)
 
 
+asyncio.run(repl())
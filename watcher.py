@@ -0,0 +1,52 @@
+import os
+
+from language import Language
+
+
+class LanguageWatcher:
+    """
+    Watches the source files of a language, and reloads the ones that changed with Language.reload.
+    Call poll() now and then from the thread that uses the language, e.g. before each command, reloading from another
+    thread while the dictionary is being read could leave it half updated
+    """
+    def __init__(self, lang: Language):
+        self.lang = lang
+        self._stats = {name: self._stat(name) for name in Language.FILES}
+
+    def _stat(self, name):
+        try:
+            stat = os.stat(self.lang.file_path(name))
+        except FileNotFoundError:
+            return None  # Probably being saved, it's picked up once it's back
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self):
+        """
+        Reloads every file that changed since it was last reloaded.
+        Returns (name, changes, error) for each of them, changes are as returned by Language.update_rules
+        """
+        results = {}
+        pending = []
+
+        for name in Language.FILES:
+            stat = self._stat(name)
+            if stat is not None and stat != self._stats[name]:
+                pending.append((name, stat))
+
+        while pending:
+            failed = []
+
+            for name, stat in pending:
+                try:
+                    results[name] = name, self.lang.reload(name), None
+                    self._stats[name] = stat
+                except Exception as e:
+                    results[name] = name, None, e  # The language is left as it was, until the file is fixed
+                    failed.append((name, stat))
+
+            # An edit can span files, e.g. a letter removed from the romanization and from the words using it.
+            # Files that failed are tried again while others still reload, and on every poll until they work
+            pending = failed if len(failed) < len(pending) else []
+
+        return [results[name] for name in Language.FILES if name in results]
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class WavCache:
+    """
+    Synthesized WAVs saved under path, named by a hash of the text and every espeak-ng setting that changes how it
+    sounds, so the same text is only synthesized once. Reading a WAV marks it as used, and once the cache is bigger
+    than max_size the least recently used ones are deleted, until it is down to low_water of max_size so that it isn't
+    scanned again on the very next put.
+    """
+    def __init__(self, path, max_size=200 * 1024 * 1024, low_water=0.9):
+        self.path = path
+        self.max_size = max_size
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def key(text, fmt, settings):
+        """Hash of text in fmt as it would be said with settings, see ESpeakNG.settings"""
+        data = json.dumps([text, fmt, settings], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def file_path(self, key):
+        return os.path.join(self.path, key + ".wav")
+
+    def get(self, key):
+        """The WAV saved for key, or None"""
+        path = self.file_path(key)
+
+        try:
+            with open(path, "rb") as f:
+                wav = f.read()
+            os.utime(path)  # Most recently used, for eviction
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return wav
+
+    def put(self, key, wav):
+        path = self.file_path(key)
+        # Never seen half written, even by other threads or processes putting the same key
+        temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+        try:
+            replaced = os.stat(path).st_size  # Another thread or process can have synthesized the same text
+        except FileNotFoundError:
+            replaced = 0
+
+        with open(temp_path, "wb") as f:
+            f.write(wav)
+        os.replace(temp_path, path)
+
+        self._size += len(wav) - replaced
+        if self._size > self.max_size:
+            self.evict()
+
+    def synth(self, espeakng, text, fmt='txt'):
+        """The WAV of espeakng saying text, only synthesizing it if it isn't saved already"""
+        key = self.key(text, fmt, espeakng.settings)
+        wav = self.get(key)
+
+        if wav is None:
+            wav = espeakng.synth_wav(text, fmt)
+            self.put(key, wav)
+
+        return wav
+
+    def _entries(self):
+        entries = []
+
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".wav"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Evicted by another process
+                entries.append((stat.st_mtime_ns, entry.path, stat.st_size))
+
+        return entries
+
+    def evict(self):
+        """Deletes the least recently used WAVs until the cache is down to low_water of max_size"""
+        entries = sorted(self._entries())  # Other processes could have added to it too
+        size = sum(size for _, _, size in entries)
+        target = self.max_size * self.low_water
+
+        for _, path, file_size in entries:
+            if size <= target:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+        self._size = size
+
+    def clear(self):
+        for _, path, _ in self._entries():
+            os.remove(path)
+        self._size = 0